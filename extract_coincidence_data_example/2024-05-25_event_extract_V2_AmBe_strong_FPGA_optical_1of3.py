@@ -2,11 +2,17 @@
 
 import os
 import math
-# import functools
+import time
+import datetime
+import functools
+import multiprocessing
 import numpy as np
 # import itertools
 import json
-from numba import jit
+
+from coincidence_functions import event_PSD_dtype, coincidence_dtype, make_slices, process_slice
+from coincidence_functions import prepare_cache, make_cached_slices, process_cached_slice
+from coincidence_functions import make_bin_edges, make_histograms, fill_histograms, chunk_location
 
 # =============================================================================
 # Settings
@@ -21,6 +27,8 @@ channels_b = [2, 3, 4, 5, 6]
 # file_name = r"E:\Data\\"
 file_name = r"F:\abcd_data\2024-05-08_AmBe_strong_FPGA_optical_cut60keV_PSD\\"
 file_name = file_name + "2024-05-08T18-42-41_DT5730_FPGA_AmBe-strong_Ch0_CLLBC1_HV-810_Ch1_CLLBC2_HV-760_Ch2_TheBeast_HV700_Ch3_LaBr19.2_HV626_Ch4_LaBr19.4_HV539_Ch5_LaBr19.6_HV539_Ch6_LaBr19.8_HV620_Ch7_CLLBC3_HV790_events.ade"
+# All files are done in one run, add the other parts of a split data set here
+file_names = [file_name]
 
 # Where to save
 csv_folder = 'csv_folder'
@@ -45,237 +53,332 @@ PSD_res = 0.0012
 PSD_min = -0.2
 PSD_max = 1
 
-# This should be 160 MB
-buffer_size = 16 * 10 * 1024 * 1024
-
-# =============================================================================
-# Main
-# =============================================================================
+# Cuts of the b channels, if they should not be the same as above
+energy_min_b = energy_min
+energy_max_b = energy_max
+PSD_min_b = PSD_min
+PSD_max_b = PSD_max
 
-print("Filename: {}".format(file_name))
+# What to save, all coincidence events and/or histograms of them per pair
+# Histograms use the _res settings above and take the same memory for any run length
+save_events = True
+save_histograms = False
 
-# How big is the file, how many chunks have to be read?
-file_size = os.path.getsize(file_name)
-print("Filesize: {} MB".format(file_size))
-
-chunks_needed = file_size / buffer_size
-print("Required chunks: {:d}".format(math.ceil(chunks_needed)))
-
-buffer_size = buffer_size - (buffer_size % 16)
-print("Using buffer size: {:d}".format(buffer_size))
-
-event_PSD_dtype = np.dtype([('timestamp', np.uint64),
-                            ('qshort', np.uint16),
-                            ('qlong', np.uint16),
-                            ('baseline', np.uint16),
-                            ('channel', np.uint8),
-                            ('pur', np.uint8),
-                            ])
-
-print("Selected channels for a: {}".format(channels_a))
-print("Selected channels for b: {}".format(channels_b))
+# This should be 160 MB
+buffer_size = 16 * 10 * 1024 * 1024
 
-N_a = len(channels_a)
-N_b = len(channels_b)
-N_ab = int(N_a * N_b)
+# Carry events over the chunk edges, then the result does not depend on buffer_size
+streaming = True
+# Largest timestamp disorder between channels in the file, in units of ns
+time_disorder = 10000
 
-# Coincidence array to store events in
-coincidence_events = np.empty((0, 7))
+# Keep a per-channel, time-sorted copy of the data next to each .ade file,
+# made on the first run and used by the runs after as long as the file is the same
+use_cache = True
 
-counter = 0
+# Number of processes working on chunks at the same time, os.cpu_count() for all
+# Every worker needs memory for a few chunks
+workers = 1
 
-with open('jsons\\Co60_zeros_FPGA.json', 'r') as json_file:
-    loaded_json = json.load(json_file)
+# To resume after an error, the chunk to start from, as printed with the error
+# The chunks before it are not in the saved results of this run
+start_chunk = 0
 
 # =============================================================================
-# Function
+# Main
 # =============================================================================
 
-@jit(nopython=True)
-def process_data(channels, timestamps, qlongs, PSDs,
-                 ch_a, ch_b,
-                 energy_min, energy_max, PSD_min, PSD_max,
-                 time_min, time_max, offset):
+# Worker processes import this file again on Windows, so only run from here
+if __name__ == '__main__':
     
-    # To store coincidence events
-    coincidence_events_chunk = np.empty((0, 7))
+    buffer_size = buffer_size - (buffer_size % 16)
+    print("Using buffer size: {:d}".format(buffer_size))
     
-    # Loop over the events
-    for i_event, (event_ch, event_timestamp, event_energy, event_PSD) in enumerate(zip(channels, timestamps, qlongs, PSDs)):
-        
-        # Find channel a
-        if event_ch == ch_a and energy_min < event_energy < energy_max and PSD_min < event_PSD < PSD_max:
-            
-            # The region to look for coincidence detections
-            event_timestamp = event_timestamp
-            left_edge = time_min + event_timestamp
-            right_edge = time_max + event_timestamp
+    events_per_chunk = buffer_size // event_PSD_dtype.itemsize
+    
+    # A resumed run does not overwrite the results of the run before
+    if start_chunk > 0:
+        save_name = save_name + '_from_chunk_{:d}'.format(start_chunk)
+    
+    print("Selected channels for a: {}".format(channels_a))
+    print("Selected channels for b: {}".format(channels_b))
+    
+    N_a = len(channels_a)
+    N_b = len(channels_b)
+    N_ab = int(N_a * N_b)
+    
+    with open('jsons\\Co60_zeros_FPGA.json', 'r') as json_file:
+        loaded_json = json.load(json_file)
+    
+    # Dense lookup tables indexed by [ch_a, ch_b], failed pairs are masked out
+    N_channels = max(channels_a + channels_b) + 1
+    
+    offsets = np.zeros((N_channels, N_channels))
+    pair_mask = np.zeros((N_channels, N_channels), dtype=np.bool_)
+    
+    for ch_a in channels_a:
+        for ch_b in channels_b:
+            offset = loaded_json[str(ch_a)][str(ch_b)]
+            if offset == 'failed':
+                print('    will not do a:' + str(ch_a) + ', b:' + str(ch_b))
+                continue
             
-            # Check for coincidences BEFORE and AFTER first detection
-            for i_other in range(i_event + 1, len(timestamps)):
-                # AFTER
-                other_timestamp = timestamps[i_other]
-                if left_edge + offset < other_timestamp < right_edge + offset:
-                    
-                    other_ch = channels[i_other]
-                    other_energy = qlongs[i_other]
-                    other_PSD = PSDs[i_other]
-                    
-                    if other_ch == ch_b and energy_min < other_energy < energy_max and PSD_min < other_PSD < PSD_max:
-                        
-                        time_diff = other_timestamp - event_timestamp - offset
-                        
-                        new_row = np.array([
-                            ch_a, ch_b, 
-                            event_energy, other_energy,
-                            event_PSD, other_PSD,
-                            time_diff
-                            ])
-                        new_row = new_row.reshape(1, 7)
-                        coincidence_events_chunk = np.vstack((coincidence_events_chunk, new_row))
-                else:
-                    # To avoid unnecessary data
-                    break
-            for i_other in range(i_event - 1, -1, -1):
-                # BEFORE
-                other_timestamp = timestamps[i_other]
-                if left_edge + offset < other_timestamp < right_edge + offset:
-                    
-                    other_ch = channels[i_other]
-                    other_energy = qlongs[i_other]
-                    other_PSD = PSDs[i_other]
-                    
-                    if other_ch == ch_b and energy_min < other_energy < energy_max and PSD_min < other_PSD < PSD_max:
-                        
-                        time_diff = other_timestamp - event_timestamp - offset
-                        
-                        new_row = np.array([
-                            ch_a, ch_b, 
-                            event_energy, other_energy,
-                            event_PSD, other_PSD,
-                            time_diff
-                            ])
-                        new_row = new_row.reshape(1, 7)
-                        coincidence_events_chunk = np.vstack((coincidence_events_chunk, new_row))
-                else:
-                    # To avoid unnecessary data
-                    break
-    return coincidence_events_chunk
-
-# =============================================================================
-# Open
-# =============================================================================
-
-with open(file_name, "rb") as input_file:
-    while True:
+            offsets[ch_a, ch_b] = offset
+            pair_mask[ch_a, ch_b] = True
+    
+    # How far in time a coincidence can reach, in units of ns
+    time_margin = max(abs(time_min), abs(time_max))
+    if pair_mask.any():
+        time_margin += np.max(np.abs(offsets[pair_mask]))
+    
+    # Everything the workers need to process a chunk
+    settings = {
+        'channels_a':channels_a,
+        'channels_b':channels_b,
+        'N_channels':N_channels,
+        'ns_per_sample':ns_per_sample,
+        'offsets':offsets,
+        'pair_mask':pair_mask,
+        'energy_min':energy_min,
+        'energy_max':energy_max,
+        'PSD_min':PSD_min,
+        'PSD_max':PSD_max,
+        'energy_min_b':energy_min_b,
+        'energy_max_b':energy_max_b,
+        'PSD_min_b':PSD_min_b,
+        'PSD_max_b':PSD_max_b,
+        'time_min':time_min,
+        'time_max':time_max,
+        'time_margin':time_margin,
+        'time_disorder':time_disorder,
+        'streaming':streaming,
+        }
+    
+    # Cut every file in chunks, each chunk owns a range of a event times
+    slices = []
+    # Bytes of the file that each chunk stands for, for the progress
+    slice_bytes = []
+    for file_name in file_names:
+        print("Filename: {}".format(file_name))
+        
+        # How big is the file, how many chunks have to be read?
+        file_size = os.path.getsize(file_name)
+        print("Filesize: {} MB".format(file_size))
+        
+        chunks_needed = file_size / buffer_size
+        print("Required chunks: {:d}".format(math.ceil(chunks_needed)))
+        
+        if use_cache:
+            cache_folder = prepare_cache(file_name, ns_per_sample, events_per_chunk)
+            file_slices = make_cached_slices(cache_folder, events_per_chunk, settings)
+        else:
+            file_slices = make_slices(file_name, events_per_chunk, settings)
+        
+        # No events of the used channels in this file
+        if not file_slices:
+            print("WARNING: No chunks to read in {}, skipping it".format(file_name))
+            continue
+        
+        if use_cache:
+            # About the same number of events in every cached chunk
+            slice_bytes += [file_size / len(file_slices)] * len(file_slices)
+        else:
+            slice_bytes += [int(stop - start) * event_PSD_dtype.itemsize for file_name, start, stop, owned_min, owned_max in file_slices]
+        slices += file_slices
+    
+    # =============================================================================
+    # Open
+    # =============================================================================
+    
+    # Coincidence arrays from every chunk, concatenated once at the end
+    coincidence_chunks = [np.empty(0, dtype=coincidence_dtype)]
+    coincidences_number = 0
+    
+    if save_histograms:
+        pairs = [(ch_a, ch_b) for ch_a in channels_a for ch_b in channels_b if pair_mask[ch_a, ch_b]]
+        histograms = make_histograms(pairs,
+                                     make_bin_edges(time_min, time_max, time_res),
+                                     make_bin_edges(energy_min, energy_max, energy_res),
+                                     make_bin_edges(PSD_min, PSD_max, PSD_res))
+    late_events = 0
+    out_of_order = 0
+    events_number = 0
+    
+    if use_cache:
+        worker_function = functools.partial(process_cached_slice, settings=settings)
+    else:
+        worker_function = functools.partial(process_slice, settings=settings)
+    
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        # Results come back in the order of the chunks, so in time order
+        results = pool.imap(worker_function, slices[start_chunk:])
+    else:
+        pool = None
+        results = map(worker_function, slices[start_chunk:])
+    
+    # Per chunk numbers, also saved next to key_info.json
+    chunk_stats = []
+    stage_times = {'read':0.0, 'select':0.0, 'sort':0.0, 'kernel':0.0, 'append':0.0}
+    run_error = None
+    
+    total_bytes = sum(slice_bytes[start_chunk:])
+    done_bytes = 0
+    run_start = time.perf_counter()
+    
+    for counter in range(start_chunk, len(slices)):
         try:
-            print("    Reading chunk: {:d}".format(counter))
-            
-            file_chunk = input_file.read(buffer_size)
-            
-            # Check if we finished
-            if not file_chunk:
-                break
-            
-            data = np.frombuffer(file_chunk, dtype=event_PSD_dtype)
-            
-            # Only select data with positive energy
-            channels_selection = np.logical_or(np.isin(data['channel'], channels_a), np.isin(data['channel'], channels_b))
-            energy_selection = data['qlong'] > 0
-            selection = np.logical_and(channels_selection, energy_selection)
-            selected_data = data[selection]
-            sorted_data = np.sort(selected_data, order = 'timestamp')
-            # sorted_data = selected_data
-            
-            channels = sorted_data['channel']
-            timestamps = sorted_data['timestamp'] * ns_per_sample
-            qlongs = sorted_data['qlong']
-            qshorts = sorted_data['qshort']
-            PSDs = (qlongs.astype(np.float64) - qshorts) / qlongs
-            
-            ab_index = 0
-            
             # Save detector a AND b in coincidence stuff (energy, PSD, ToF)
-            for i_a, ch_a in enumerate(channels_a):
-                ch_selection_a = channels == ch_a
-                
-                for i_b, ch_b in enumerate(channels_b):
-                    ch_selection_b = channels == ch_b
-                    
-                    offset = loaded_json[str(ch_a)][str(ch_b)]
-                    if offset == 'failed':
-                        print('        did not do a:' + str(ch_a) + ', b:' + str(ch_b))
-                        continue
-                    
-                    new_event_chunk = process_data(channels, 
-                                                   timestamps, 
-                                                   qlongs, 
-                                                   PSDs,
-                                                   ch_a, ch_b,
-                                                   energy_min, energy_max, 
-                                                   PSD_min, PSD_max,
-                                                   time_min, time_max, 
-                                                   offset)
-                    
-                    coincidence_events = np.vstack((coincidence_events, new_event_chunk))
-                    
-                    ab_index += 1
-            counter += 1
+            new_event_chunk, stats = next(results)
+            
+            append_start = time.perf_counter()
+            coincidences_number += len(new_event_chunk)
+            if save_events:
+                coincidence_chunks.append(new_event_chunk)
+            if save_histograms:
+                fill_histograms(histograms, new_event_chunk)
+            late_events += stats['late_events']
+            out_of_order += stats['out_of_order']
+            events_number += stats['events']
+            stats['append_time'] = time.perf_counter() - append_start
             
         except Exception as error:
-            print("    ERROR: {}".format(error))
+            # The chunks before this one are done, the run can go on from here
+            run_error = dict(chunk_location(slices[counter]), chunk=counter, error=repr(error))
+            print("    ERROR in chunk {:d}: {}".format(counter, error))
+            print("    Chunk {:d} starts at {}".format(counter, chunk_location(slices[counter])))
+            print("    To resume, set start_chunk = {:d}".format(counter))
             break
-
-# =============================================================================
-# Save histograms
-# =============================================================================
-
-print('\nStarting to save...')
-
-# make folder to save everything in
-main_folder = csv_folder + '\\' + save_folder
-try:
-    os.makedirs(main_folder)
-except FileExistsError:
-    print(f"Folder '{main_folder}' already exists!")
-
-
-
-sub_folder = main_folder + '\\' + 'both_channels_ab'
-try:
-    os.makedirs(sub_folder)
-except FileExistsError:
-    print(f"Folder '{sub_folder}' already exists!")
-
-
-
-output_name = sub_folder + '\\' + save_name + '_' + 'coincidence_events'
-np.save(output_name + '.npy', coincidence_events)
-
-print('Save step 1 done...')
-
-# save key info
-save_info = {
-    'channels a':channels_a,
-    'channels_b':channels_b,
-    'ns_per_sample':ns_per_sample,
-    'time_min':time_min,
-    'time_max':time_max,
-    'time_units':'ns',
-    'energy_min':energy_min,
-    'energy_max':energy_max,
-    'energy_units':'ch',
-    'PSD_min':PSD_min,
-    'PSD_max':PSD_max,
-    'PSD_units':'(qlong-qshort)/qlong'
-    }
-
-with open(main_folder + '\\key_info.json', 'w') as json_file:
-    json.dump(save_info, json_file, indent=4)
-
-print('Save step 2 done...')
-
-print('\nDONE!')
-
-
-
+        
+        # With workers the wall time is only the wait for the chunk, the rates come from its own stages
+        chunk_time = sum(stats[stage + '_time'] for stage in stage_times)
+        done_bytes += slice_bytes[counter]
+        run_time = time.perf_counter() - run_start
+        eta = run_time / done_bytes * (total_bytes - done_bytes) if done_bytes > 0 else 0.0
+        
+        for stage in stage_times:
+            stage_times[stage] += stats[stage + '_time']
+        
+        chunk_stats.append({
+            'chunk':counter,
+            'time':chunk_time,
+            'bytes':slice_bytes[counter],
+            'events':int(stats['events']),
+            'coincidences':len(new_event_chunk),
+            'times':{stage:stats[stage + '_time'] for stage in stage_times},
+            })
+        
+        print("    Chunk {:d} of {:d}: {:.1f} MB/s, {:.0f} events/s, {:.0f} coincidences/s, ETA {}".format(
+            counter + 1, len(slices), slice_bytes[counter] / 1024**2 / chunk_time, stats['events'] / chunk_time,
+            len(new_event_chunk) / chunk_time, datetime.timedelta(seconds=round(eta))))
+        print("        read {:.2f} s, select {:.2f} s, sort {:.2f} s, kernel {:.2f} s, append {:.2f} s".format(
+            *[stats[stage + '_time'] for stage in stage_times]))
+    
+    run_time = time.perf_counter() - run_start
+    
+    if pool is not None:
+        pool.terminate()
+    
+    coincidence_events = np.concatenate(coincidence_chunks)
+    del coincidence_chunks
+    
+    if late_events > 0:
+        print("WARNING: {:d} events came later than time_disorder, increase it".format(late_events))
+    
+    # Only counted when the chunks are sorted here, the cache is sorted once
+    if out_of_order > 0:
+        print("Events out of time order in their channel: {:d} of {:d} read".format(out_of_order, events_number))
+    
+    print("Found coincidences: {:d}".format(coincidences_number))
+    if run_time > 0:
+        print("Run time: {:.1f} s, {:.1f} MB/s, {:.0f} events/s".format(run_time, done_bytes / 1024**2 / run_time, events_number / run_time))
+    
+    # =============================================================================
+    # Save histograms
+    # =============================================================================
+    
+    print('\nStarting to save...')
+    
+    # make folder to save everything in
+    main_folder = csv_folder + '\\' + save_folder
+    try:
+        os.makedirs(main_folder)
+    except FileExistsError:
+        print(f"Folder '{main_folder}' already exists!")
+    
+    
+    
+    sub_folder = main_folder + '\\' + 'both_channels_ab'
+    try:
+        os.makedirs(sub_folder)
+    except FileExistsError:
+        print(f"Folder '{sub_folder}' already exists!")
+    
+    
+    
+    if save_events:
+        output_name = sub_folder + '\\' + save_name + '_' + 'coincidence_events'
+        np.save(output_name + '.npy', coincidence_events)
+    
+    if save_histograms:
+        output_name = sub_folder + '\\' + save_name + '_' + 'coincidence_histograms'
+        np.savez_compressed(output_name + '.npz', **histograms)
+    
+    print('Save step 1 done...')
+    
+    # save key info
+    save_info = {
+        'channels a':channels_a,
+        'channels_b':channels_b,
+        'ns_per_sample':ns_per_sample,
+        'time_min':time_min,
+        'time_max':time_max,
+        'time_units':'ns',
+        'energy_min':energy_min,
+        'energy_max':energy_max,
+        'energy_units':'ch',
+        'PSD_min':PSD_min,
+        'PSD_max':PSD_max,
+        'PSD_units':'(qlong-qshort)/qlong',
+        'energy_min_b':energy_min_b,
+        'energy_max_b':energy_max_b,
+        'PSD_min_b':PSD_min_b,
+        'PSD_max_b':PSD_max_b,
+        'time_res':time_res,
+        'energy_res':energy_res,
+        'PSD_res':PSD_res,
+        'histograms':'per pair in pairs: ToF, energy_vs_ToF and PSD_vs_energy of detector a',
+        'coincidence_events_dtype':coincidence_dtype.descr,
+        'coincidence_events_fields':'energy is qlong, PSD is (qlong-qshort)/qlong, ToF in ns'
+        }
+    
+    with open(main_folder + '\\key_info.json', 'w') as json_file:
+        json.dump(save_info, json_file, indent=4)
+    
+    # How the run went, with the chunk to resume from after an error
+    run_summary = {
+        'start_chunk':start_chunk,
+        'chunks':len(slices),
+        'chunks_done':len(chunk_stats),
+        'workers':workers,
+        'use_cache':use_cache,
+        'run_time':run_time,
+        'bytes':done_bytes,
+        'events':int(events_number),
+        'coincidences':int(coincidences_number),
+        'bytes_per_s':done_bytes / run_time if run_time > 0 else 0.0,
+        'events_per_s':events_number / run_time if run_time > 0 else 0.0,
+        'coincidences_per_s':coincidences_number / run_time if run_time > 0 else 0.0,
+        'stage_times':stage_times,
+        'late_events':int(late_events),
+        'out_of_order':int(out_of_order),
+        'error':run_error,
+        'chunk_stats':chunk_stats,
+        }
+    
+    with open(main_folder + '\\' + save_name + '_run_summary.json', 'w') as json_file:
+        json.dump(run_summary, json_file, indent=4)
+    
+    print('Save step 2 done...')
+    
+    print('\nDONE!')
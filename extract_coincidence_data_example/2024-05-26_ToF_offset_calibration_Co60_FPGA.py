@@ -0,0 +1,199 @@
+# Elias Arnqvist
+
+"""
+Makes the ToF offsets json that the extraction script loads, as
+loaded_json[ch_a][ch_b], from a Co-60 .ade file.
+
+The ToF histograms of all pairs are filled in one pass over the file, with
+the same chunks as the extraction and no offsets. The prompt peak of every
+pair is fitted, and its position is the offset. Pairs with too few counts in
+the peak for a fit get "failed".
+"""
+
+import os
+import math
+import functools
+import multiprocessing
+import numpy as np
+import json
+
+from coincidence_functions import event_PSD_dtype, make_slices, process_slice
+from coincidence_functions import prepare_cache, make_cached_slices, process_cached_slice
+from coincidence_functions import make_bin_edges, make_ToF_histograms, fill_ToF_histograms, fit_prompt_peak
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Channels to use for neutron detection
+channels_a = [0, 1, 7]
+# Channels to use for gamma detection trigger
+channels_b = [2, 3, 4, 5, 6]
+
+# What to read
+file_name = r"F:\abcd_data\2024-05-08_Co60_FPGA_optical\\"
+file_name = file_name + "2024-05-08T12-00-00_DT5730_FPGA_Co60_events.ade"
+# All files are done in one run, add the other parts of a split data set here
+file_names = [file_name]
+
+# Where to save, the extraction script reads jsons\Co60_zeros_FPGA.json
+json_folder = 'jsons'
+save_name = 'Co60_zeros_FPGA'
+
+# For 500 MHz sampling, 1/500e6=2e-9 or 2 ns, then divide by 1024
+ns_per_sample = 2.0 / 1024
+
+# In units of ns, wide enough for the largest offset
+time_res = 0.25
+time_min = -500
+time_max = 500
+
+# In units of keV, everything by default
+energy_min = 0
+energy_max = 66000
+
+# Using PSDlib
+PSD_min = -0.2
+PSD_max = 1
+
+# Fit range on each side of the highest bin, in units of ns
+fit_width = 10
+# Fewer counts than this above the random coincidences in the fit range is "failed"
+min_counts = 100
+# Also "failed" when the peak is less than this many standard deviations of the random coincidences
+min_significance = 5
+
+# This should be 160 MB
+buffer_size = 16 * 10 * 1024 * 1024
+
+# Carry events over the chunk edges, then the result does not depend on buffer_size
+streaming = True
+# Largest timestamp disorder between channels in the file, in units of ns
+time_disorder = 10000
+
+# Keep a per-channel, time-sorted copy of the data next to each .ade file
+use_cache = True
+
+# Number of processes working on chunks at the same time, os.cpu_count() for all
+workers = 1
+
+# =============================================================================
+# Main
+# =============================================================================
+
+# Worker processes import this file again on Windows, so only run from here
+if __name__ == '__main__':
+
+    buffer_size = buffer_size - (buffer_size % 16)
+    events_per_chunk = buffer_size // event_PSD_dtype.itemsize
+
+    print("Selected channels for a: {}".format(channels_a))
+    print("Selected channels for b: {}".format(channels_b))
+
+    # Every pair at once, without offsets
+    N_channels = max(channels_a + channels_b) + 1
+
+    pairs = [(ch_a, ch_b) for ch_a in channels_a for ch_b in channels_b if ch_a != ch_b]
+
+    offsets = np.zeros((N_channels, N_channels))
+    pair_mask = np.zeros((N_channels, N_channels), dtype=np.bool_)
+    for ch_a, ch_b in pairs:
+        pair_mask[ch_a, ch_b] = True
+
+    settings = {
+        'channels_a':channels_a,
+        'channels_b':channels_b,
+        'N_channels':N_channels,
+        'ns_per_sample':ns_per_sample,
+        'offsets':offsets,
+        'pair_mask':pair_mask,
+        'energy_min':energy_min,
+        'energy_max':energy_max,
+        'PSD_min':PSD_min,
+        'PSD_max':PSD_max,
+        'time_min':time_min,
+        'time_max':time_max,
+        'time_margin':max(abs(time_min), abs(time_max)),
+        'time_disorder':time_disorder,
+        'streaming':streaming,
+        }
+
+    slices = []
+    for file_name in file_names:
+        print("Filename: {}".format(file_name))
+
+        file_size = os.path.getsize(file_name)
+        print("Filesize: {} MB".format(file_size))
+        print("Required chunks: {:d}".format(math.ceil(file_size / buffer_size)))
+
+        if use_cache:
+            cache_folder = prepare_cache(file_name, ns_per_sample, events_per_chunk)
+            slices += make_cached_slices(cache_folder, events_per_chunk, settings)
+        else:
+            slices += make_slices(file_name, events_per_chunk, settings)
+
+    # =============================================================================
+    # Histograms
+    # =============================================================================
+
+    histograms = make_ToF_histograms(pairs, make_bin_edges(time_min, time_max, time_res))
+
+    if use_cache:
+        worker_function = functools.partial(process_cached_slice, settings=settings)
+    else:
+        worker_function = functools.partial(process_slice, settings=settings)
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(worker_function, slices)
+    else:
+        pool = None
+        results = map(worker_function, slices)
+
+    # The coincidences of a chunk are only kept until they are in the histograms
+    for counter in range(len(slices)):
+        print("    Reading chunk: {:d}".format(counter))
+
+        new_event_chunk, stats = next(results)
+        fill_ToF_histograms(histograms, new_event_chunk)
+
+    if pool is not None:
+        pool.terminate()
+
+    # =============================================================================
+    # Fits
+    # =============================================================================
+
+    offsets_json = {str(ch_a):dict() for ch_a in channels_a}
+    fits_json = {str(ch_a):dict() for ch_a in channels_a}
+
+    for i_pair, (ch_a, ch_b) in enumerate(pairs):
+        fit = fit_prompt_peak(histograms['time_edges'], histograms['ToF'][i_pair], fit_width, min_counts, min_significance)
+
+        if fit is None:
+            print('    failed a:' + str(ch_a) + ', b:' + str(ch_b))
+            offsets_json[str(ch_a)][str(ch_b)] = 'failed'
+            fits_json[str(ch_a)][str(ch_b)] = 'failed'
+            continue
+
+        print('    a:{:d}, b:{:d}, offset: {:.3f} +- {:.3f} ns, sigma: {:.3f} ns, counts: {:.0f}'.format(
+            ch_a, ch_b, fit['offset'], fit['offset_error'], fit['sigma'], fit['peak_counts']))
+        offsets_json[str(ch_a)][str(ch_b)] = fit['offset']
+        fits_json[str(ch_a)][str(ch_b)] = fit
+
+    # =============================================================================
+    # Save
+    # =============================================================================
+
+    os.makedirs(json_folder, exist_ok=True)
+
+    with open(os.path.join(json_folder, save_name + '.json'), 'w') as json_file:
+        json.dump(offsets_json, json_file, indent=4)
+
+    # The fits and histograms, to check the offsets by eye
+    with open(os.path.join(json_folder, save_name + '_fits.json'), 'w') as json_file:
+        json.dump(fits_json, json_file, indent=4)
+
+    np.savez_compressed(os.path.join(json_folder, save_name + '_histograms.npz'), **histograms)
+
+    print('\nDONE!')
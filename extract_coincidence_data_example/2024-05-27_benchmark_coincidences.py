@@ -0,0 +1,276 @@
+# Elias Arnqvist
+
+"""
+Benchmark of the coincidence extraction on a synthetic .ade file, made with
+synthetic_events.py, so that it runs on any computer without detector data.
+
+For every chunk the stages read, select, sort, process_data and append are
+timed. The peak memory that each of them allocates is measured in a second
+pass, since tracemalloc slows down the allocations a lot. The coincidences
+found by the whole extraction, from the file and from the cache, are then
+compared with the injected ones, which shows coincidences lost at the chunk
+edges or found twice.
+"""
+
+import os
+import time
+import json
+import tracemalloc
+import numpy as np
+
+from coincidence_functions import event_PSD_dtype, coincidence_dtype, map_events, make_slices, process_slice
+from coincidence_functions import padded_range, sort_by_channel, find_coincidences
+from coincidence_functions import prepare_cache, make_cached_slices, process_cached_slice
+from synthetic_events import generate_events, write_events, compare_with_truth
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Channels to use for neutron detection
+channels_a = [0, 1, 7]
+# Channels to use for gamma detection trigger
+channels_b = [2, 3, 4, 5, 6]
+
+# Events per second in every channel
+rates = {channel:50000 for channel in channels_a + channels_b}
+# Length of the synthetic measurement, in units of ns
+duration = 20e9
+# Fraction of the a events with a partner in a b channel
+coincidence_fraction = 0.2
+# Spread of the ToF around the offset of the pair, in units of ns
+ToF_sigma = 2
+# Largest delay of an event in the file, in units of ns
+jitter = 5000
+# Seed of the random numbers, the same seed gives the same file
+seed = 0
+
+# Where the synthetic file, the cache and the results go
+benchmark_folder = 'benchmark'
+benchmark_name = 'synthetic'
+
+# For 500 MHz sampling, 1/500e6=2e-9 or 2 ns, then divide by 1024
+ns_per_sample = 2.0 / 1024
+
+# In units of ns
+time_min = -150
+time_max = 100
+
+# In units of keV
+energy_min = 1000
+energy_max = 60000
+
+# Using PSDlib
+PSD_min = 0
+PSD_max = 0.45
+
+# Smaller than in the extraction, so that there are many chunk edges
+buffer_size = 16 * 1024 * 1024
+
+# Largest timestamp disorder between channels in the file, in units of ns
+time_disorder = 10000
+
+# =============================================================================
+# Functions
+# =============================================================================
+
+def measure(stage, times, memory, function, *arguments):
+
+    # Wall time and, when tracing, the most memory allocated above the start, over all chunks
+    tracemalloc.reset_peak()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    time_start = time.perf_counter()
+
+    result = function(*arguments)
+
+    times[stage] = times.get(stage, 0.0) + time.perf_counter() - time_start
+    memory[stage] = max(memory.get(stage, 0), tracemalloc.get_traced_memory()[1] - memory_start)
+
+    return result
+
+def read_stage(mapped_data, task, settings):
+    file_name, start, stop, owned_min, owned_max = task
+    start, stop = padded_range(mapped_data, start, stop, owned_min, owned_max, settings)
+
+    # A copy, so that the pages are read here and not in the later stages
+    return np.array(mapped_data[start:stop])
+
+def select_stage(data, settings):
+    channels_selection = np.logical_or(np.isin(data['channel'], settings['channels_a']), np.isin(data['channel'], settings['channels_b']))
+    return data[np.logical_and(channels_selection, data['qlong'] > 0)]
+
+def sort_stage(selected_data, settings):
+    order, channel_starts, out_of_order = sort_by_channel(selected_data['channel'],
+                                                          selected_data['timestamp'],
+                                                          settings['N_channels'])
+    grouped_data = selected_data[order]
+
+    timestamps = grouped_data['timestamp'] * settings['ns_per_sample']
+    qlongs = grouped_data['qlong']
+    PSDs = (qlongs.astype(np.float64) - grouped_data['qshort']) / qlongs
+
+    return channel_starts, timestamps, qlongs, PSDs
+
+def save_stage(coincidence_chunks, output_name):
+    coincidence_events = np.concatenate(coincidence_chunks)
+    np.save(output_name, coincidence_events)
+    return coincidence_events
+
+def run_stages(file_name, events_per_chunk, settings, output_name):
+
+    times = dict()
+    memory = dict()
+
+    mapped_data = map_events(file_name)
+    coincidence_chunks = [np.empty(0, dtype=coincidence_dtype)]
+
+    for task in make_slices(file_name, events_per_chunk, settings):
+        owned_min, owned_max = task[3], task[4]
+
+        data = measure('read', times, memory, read_stage, mapped_data, task, settings)
+        selected_data = measure('select', times, memory, select_stage, data, settings)
+        channel_starts, timestamps, qlongs, PSDs = measure('sort', times, memory, sort_stage, selected_data, settings)
+        new_event_chunk = measure('process_data', times, memory, find_coincidences,
+                                  channel_starts, timestamps, qlongs, PSDs, owned_min, owned_max, settings)
+        measure('append', times, memory, coincidence_chunks.append, new_event_chunk)
+
+    measure('save', times, memory, save_stage, coincidence_chunks, output_name)
+
+    return times, memory
+
+def run_extraction(worker_function, slices):
+
+    # The whole extraction as in the extraction script, with one worker
+    time_start = time.perf_counter()
+    coincidence_chunks = [np.empty(0, dtype=coincidence_dtype)]
+    for task in slices:
+        new_event_chunk, stats = worker_function(task)
+        coincidence_chunks.append(new_event_chunk)
+
+    return np.concatenate(coincidence_chunks), time.perf_counter() - time_start
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == '__main__':
+
+    os.makedirs(benchmark_folder, exist_ok=True)
+    file_name = os.path.join(benchmark_folder, benchmark_name + '_events.ade')
+
+    # Offsets of a few ns to tens of ns, like between real detectors
+    N_channels = max(channels_a + channels_b) + 1
+    offsets = np.zeros((N_channels, N_channels))
+    pair_mask = np.zeros((N_channels, N_channels), dtype=np.bool_)
+    for ch_a in channels_a:
+        for ch_b in channels_b:
+            offsets[ch_a, ch_b] = 3.7 * (ch_b - ch_a)
+            pair_mask[ch_a, ch_b] = True
+
+    print("Generating events")
+    events, truth = generate_events(rates, duration, channels_a, channels_b, offsets,
+                                    coincidence_fraction, ToF_sigma, jitter, ns_per_sample, seed)
+    write_events(file_name, events)
+
+    file_size = os.path.getsize(file_name)
+    print("Filesize: {} MB".format(file_size / 1024**2))
+    print("Events: {:d}, injected coincidences: {:d}".format(len(events), len(truth)))
+    del events
+
+    time_margin = max(abs(time_min), abs(time_max)) + np.max(np.abs(offsets[pair_mask]))
+
+    settings = {
+        'channels_a':channels_a,
+        'channels_b':channels_b,
+        'N_channels':N_channels,
+        'ns_per_sample':ns_per_sample,
+        'offsets':offsets,
+        'pair_mask':pair_mask,
+        'energy_min':energy_min,
+        'energy_max':energy_max,
+        'PSD_min':PSD_min,
+        'PSD_max':PSD_max,
+        'time_min':time_min,
+        'time_max':time_max,
+        'time_margin':time_margin,
+        'time_disorder':time_disorder,
+        'streaming':True,
+        }
+
+    buffer_size = buffer_size - (buffer_size % 16)
+    events_per_chunk = buffer_size // event_PSD_dtype.itemsize
+
+    # Compile process_data before anything is timed
+    find_coincidences(np.zeros(N_channels + 1, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.uint16),
+                      np.zeros(0), -np.inf, np.inf, settings)
+
+    # =============================================================================
+    # Stages
+    # =============================================================================
+
+    output_name = os.path.join(benchmark_folder, benchmark_name + '_coincidence_events.npy')
+    times, _ = run_stages(file_name, events_per_chunk, settings, output_name)
+
+    tracemalloc.start()
+    _, memory = run_stages(file_name, events_per_chunk, settings, output_name)
+    tracemalloc.stop()
+
+    total_time = sum(times.values())
+    print("\nStage          time (s)   share   MB/s     peak memory (MB)")
+    for stage in times:
+        print("{:14s} {:8.3f}   {:5.1%}   {:8.1f} {:8.1f}".format(stage, times[stage], times[stage] / total_time,
+                                                                     file_size / 1024**2 / times[stage], memory[stage] / 1024**2))
+    print("Total: {:.3f} s, {:.0f} events/s".format(total_time, file_size / event_PSD_dtype.itemsize / total_time))
+
+    # =============================================================================
+    # Correctness
+    # =============================================================================
+
+    results = dict()
+
+    slices = make_slices(file_name, events_per_chunk, settings)
+    found, run_time = run_extraction(lambda task: process_slice(task, settings), slices)
+    results['file'] = dict(compare_with_truth(found, truth, settings), time=run_time)
+
+    settings['streaming'] = False
+    slices = make_slices(file_name, events_per_chunk, settings)
+    found, run_time = run_extraction(lambda task: process_slice(task, settings), slices)
+    results['file_not_streaming'] = dict(compare_with_truth(found, truth, settings), time=run_time)
+    settings['streaming'] = True
+
+    time_start = time.perf_counter()
+    cache_folder = prepare_cache(file_name, ns_per_sample, events_per_chunk)
+    cache_time = time.perf_counter() - time_start
+
+    slices = make_cached_slices(cache_folder, events_per_chunk, settings)
+    found, run_time = run_extraction(lambda task: process_cached_slice(task, settings), slices)
+    results['cache'] = dict(compare_with_truth(found, truth, settings), time=run_time, cache_time=cache_time)
+
+    print("\nRun                 expected    found   missed  duplicates  time (s)")
+    for run, result in results.items():
+        print("{:18s} {:9d} {:8d} {:8d} {:11d} {:9.3f}".format(run, result['expected'], result['found'],
+                                                             result['missed'], result['duplicates'], result['time']))
+
+    # Only the streaming runs have to find everything
+    for run in ('file', 'cache'):
+        if results[run]['missed'] > 0 or results[run]['duplicates'] > 0:
+            print("WARNING: {} run does not match the injected coincidences".format(run))
+
+    # =============================================================================
+    # Save
+    # =============================================================================
+
+    benchmark_info = {
+        'file_size':file_size,
+        'events':file_size // event_PSD_dtype.itemsize,
+        'injected_coincidences':len(truth),
+        'buffer_size':buffer_size,
+        'stage_times':times,
+        'stage_peak_memory':memory,
+        'runs':results,
+        }
+
+    with open(os.path.join(benchmark_folder, benchmark_name + '_benchmark.json'), 'w') as json_file:
+        json.dump(benchmark_info, json_file, indent=4)
+
+    print('\nDONE!')
@@ -0,0 +1,683 @@
+# Elias Arnqvist
+
+"""
+Functions for finding coincidences in ABCD .ade event files.
+
+They are kept here, and not in the extraction script, so that worker
+processes can import them without running the script again.
+"""
+
+import os
+import json
+import time
+import numpy as np
+from numba import jit
+from scipy.optimize import curve_fit
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+event_PSD_dtype = np.dtype([('timestamp', np.uint64),
+                            ('qshort', np.uint16),
+                            ('qlong', np.uint16),
+                            ('baseline', np.uint16),
+                            ('channel', np.uint8),
+                            ('pur', np.uint8),
+                            ])
+
+# One coincidence, energies are qlong and ToF is in units of ns
+coincidence_dtype = np.dtype([('channel_a', np.uint8),
+                              ('channel_b', np.uint8),
+                              ('energy_a', np.uint16),
+                              ('energy_b', np.uint16),
+                              ('PSD_a', np.float32),
+                              ('PSD_b', np.float32),
+                              ('ToF', np.float32),
+                              ])
+
+# Starting number of rows in the coincidence buffer of process_data
+initial_capacity = 1024
+
+# Columns of the per-channel cache, timestamps are in units of ns
+cache_columns = [('timestamp', np.float64),
+                 ('qlong', np.uint16),
+                 ('qshort', np.uint16),
+                 ('PSD', np.float64),
+                 ]
+
+# =============================================================================
+# Functions
+# =============================================================================
+
+@jit(nopython=True, cache=True)
+def grow_buffer(buffer, rows_filled):
+
+    # Double the capacity, amortized O(1) per appended row
+    new_buffer = np.empty(2 * buffer.shape[0], dtype=buffer.dtype)
+    new_buffer[:rows_filled] = buffer[:rows_filled]
+    return new_buffer
+
+def map_events(file_name):
+
+    # Only whole records, a cut off record at the end is skipped
+    events_number = os.path.getsize(file_name) // event_PSD_dtype.itemsize
+
+    if events_number == 0:
+        return np.empty(0, dtype=event_PSD_dtype)
+
+    return np.memmap(file_name, dtype=event_PSD_dtype, mode='r', shape=(events_number,))
+
+def build_channel_index(channels, N_channels):
+
+    # Stable, so each channel keeps its timestamp order from the sorted data
+    order = np.argsort(channels, kind='stable')
+
+    # Events of channel ch are at [channel_starts[ch], channel_starts[ch + 1])
+    counts = np.bincount(channels, minlength=N_channels)
+    channel_starts = np.zeros(N_channels + 1, dtype=np.int64)
+    np.cumsum(counts, out=channel_starts[1:])
+
+    return order, channel_starts
+
+def count_out_of_order(timestamps):
+    return np.count_nonzero(timestamps[1:] < timestamps[:-1])
+
+def sort_by_channel(channels, timestamps, N_channels):
+
+    # The digitizer writes each channel in time order, so grouping per channel
+    # while keeping the file order is usually enough
+    order, channel_starts = build_channel_index(channels, N_channels)
+    grouped_timestamps = timestamps[order]
+
+    # Only sort the channels where the time order check fails
+    out_of_order = 0
+    for channel in range(N_channels):
+        group = slice(channel_starts[channel], channel_starts[channel + 1])
+        channel_out_of_order = count_out_of_order(grouped_timestamps[group])
+
+        if channel_out_of_order > 0:
+            out_of_order += channel_out_of_order
+            order[group] = order[group][np.argsort(grouped_timestamps[group], kind='stable')]
+
+    return order, channel_starts, out_of_order
+
+@jit(nopython=True, cache=True)
+def process_data(starts_a, timestamps_a, qlongs_a, PSDs_a,
+                 starts_b, timestamps_b, qlongs_b, PSDs_b,
+                 offsets, pair_mask,
+                 time_min, time_max, owned_min, owned_max):
+
+    # The a and b events are already cut by select_events, so every event
+    # here is accepted and only the times are checked
+
+    # To store coincidence events, only the first rows_filled rows are valid
+    coincidence_events_chunk = np.empty(initial_capacity, dtype=coincidence_dtype)
+    rows_filled = 0
+
+    N_channels = offsets.shape[0]
+
+    # Loop over the pairs, only events of ch_a and ch_b are visited
+    for ch_a in range(N_channels):
+        for ch_b in range(N_channels):
+            if not pair_mask[ch_a, ch_b]:
+                continue
+
+            offset = offsets[ch_a, ch_b]
+
+            start_b = starts_b[ch_b]
+            stop_b = starts_b[ch_b + 1]
+
+            # First b event that can be inside the window, it only moves
+            # forward since the a events are sorted in time too
+            i_left = start_b
+
+            for i_event in range(starts_a[ch_a], starts_a[ch_a + 1]):
+                event_timestamp = timestamps_a[i_event]
+
+                # Only a events owned by this chunk, the others are done
+                # with the previous or the next chunk
+                if event_timestamp < owned_min:
+                    continue
+                if event_timestamp >= owned_max:
+                    break
+
+                # The region to look for coincidence detections
+                left_edge = time_min + event_timestamp + offset
+                right_edge = time_max + event_timestamp + offset
+
+                while i_left < stop_b and timestamps_b[i_left] <= left_edge:
+                    i_left += 1
+
+                for i_other in range(i_left, stop_b):
+                    other_timestamp = timestamps_b[i_other]
+                    if other_timestamp >= right_edge:
+                        # To avoid unnecessary data
+                        break
+
+                    time_diff = other_timestamp - event_timestamp - offset
+
+                    if rows_filled == coincidence_events_chunk.shape[0]:
+                        coincidence_events_chunk = grow_buffer(coincidence_events_chunk, rows_filled)
+
+                    new_row = coincidence_events_chunk[rows_filled]
+                    new_row.channel_a = ch_a
+                    new_row.channel_b = ch_b
+                    new_row.energy_a = qlongs_a[i_event]
+                    new_row.energy_b = qlongs_b[i_other]
+                    new_row.PSD_a = PSDs_a[i_event]
+                    new_row.PSD_b = PSDs_b[i_other]
+                    new_row.ToF = time_diff
+                    rows_filled += 1
+
+    # Only return the part of the buffer that was filled
+    return coincidence_events_chunk[:rows_filled]
+
+def make_slices(file_name, events_per_chunk, settings):
+
+    mapped_data = map_events(file_name)
+    events_number = len(mapped_data)
+
+    # Nothing to read, and no timestamps for the edges
+    if events_number == 0:
+        return []
+
+    slice_starts = np.arange(0, events_number, events_per_chunk)
+
+    if not settings['streaming']:
+        # Every slice on its own, as if the file was cut in pieces
+        return [(file_name, start, min(start + events_per_chunk, events_number), -np.inf, np.inf)
+                for start in slice_starts]
+
+    # A slice owns the a events from the newest timestamp before it, so
+    # neighbouring slices agree on the edge even if the file is not sorted
+    edges = mapped_data['timestamp'][slice_starts] * settings['ns_per_sample']
+    edges = np.maximum.accumulate(edges)
+    edges[0] = -np.inf
+    edges = np.append(edges, np.inf)
+
+    slices = []
+    for i_slice, start in enumerate(slice_starts):
+        stop = min(start + events_per_chunk, events_number)
+        slices.append((file_name, start, stop, edges[i_slice], edges[i_slice + 1]))
+
+    return slices
+
+def padded_range(mapped_data, start, stop, owned_min, owned_max, settings):
+
+    ns_per_sample = settings['ns_per_sample']
+    time_disorder = settings['time_disorder']
+    time_margin = settings['time_margin']
+    timestamps = mapped_data['timestamp']
+    events_number = len(mapped_data)
+
+    # Step back until nothing earlier in the file can be within time_margin
+    # of the owned a events, that is if it is at most time_disorder late
+    step = 1024
+    while start > 0 and timestamps[start] * ns_per_sample + time_disorder >= owned_min - time_margin:
+        start = max(start - step, 0)
+        step *= 2
+
+    # Same forward, nothing later in the file can be before the last event
+    # by more than time_disorder
+    step = 1024
+    while stop < events_number and timestamps[stop - 1] * ns_per_sample - time_disorder <= owned_max + time_margin:
+        stop = min(stop + step, events_number)
+        step *= 2
+
+    return start, stop
+
+def process_slice(task, settings):
+
+    file_name, start, stop, owned_min, owned_max = task
+
+    time_start = time.perf_counter()
+
+    mapped_data = map_events(file_name)
+    ns_per_sample = settings['ns_per_sample']
+
+    # Events older than the owned range in this slice came too late
+    own_timestamps = mapped_data['timestamp'][start:stop] * ns_per_sample
+    late_events = np.count_nonzero(own_timestamps < owned_min - settings['time_disorder'])
+
+    # Read a bit around the slice, for the coincidences over its edges
+    if settings['streaming']:
+        start, stop = padded_range(mapped_data, start, stop, owned_min, owned_max, settings)
+
+    # Record-aligned view into the file, copying the selection columns
+    # reads every page of it, so the reading is timed here
+    data = mapped_data[start:stop]
+    data_channels = np.array(data['channel'])
+    data_qlongs = np.array(data['qlong'])
+    time_read = time.perf_counter()
+
+    # Only select data with positive energy
+    channels_selection = np.logical_or(np.isin(data_channels, settings['channels_a']), np.isin(data_channels, settings['channels_b']))
+    energy_selection = data_qlongs > 0
+    selection = np.logical_and(channels_selection, energy_selection)
+    selected_data = data[selection]
+    time_select = time.perf_counter()
+
+    # Group the events per channel, sorted in time, only the columns are
+    # sorted and the records are gathered once
+    order, channel_starts, out_of_order = sort_by_channel(selected_data['channel'],
+                                                          selected_data['timestamp'],
+                                                          settings['N_channels'])
+    grouped_data = selected_data[order]
+
+    timestamps = grouped_data['timestamp'] * ns_per_sample
+    qlongs = grouped_data['qlong']
+    qshorts = grouped_data['qshort']
+    PSDs = (qlongs.astype(np.float64) - qshorts) / qlongs
+    time_sort = time.perf_counter()
+
+    new_event_chunk = find_coincidences(channel_starts, timestamps, qlongs, PSDs,
+                                        owned_min, owned_max, settings)
+    time_kernel = time.perf_counter()
+
+    stats = {
+        'events':len(grouped_data),
+        'late_events':late_events,
+        'out_of_order':out_of_order,
+        'bytes':data.nbytes,
+        'read_time':time_read - time_start,
+        'select_time':time_select - time_read,
+        'sort_time':time_sort - time_select,
+        'kernel_time':time_kernel - time_sort,
+        }
+
+    return new_event_chunk, stats
+
+def group_cuts(settings, group):
+
+    # Cuts of the a or b channels, the common cuts unless set for the group,
+    # as energy_min_b and so on
+    return [settings.get(name + '_' + group, settings[name]) for name in ('energy_min', 'energy_max', 'PSD_min', 'PSD_max')]
+
+def select_events(channel_starts, timestamps, qlongs, PSDs, channels, cuts):
+
+    energy_min, energy_max, PSD_min, PSD_max = cuts
+    N_channels = len(channel_starts) - 1
+
+    # Accepted events of the channels, in the same grouping and time order
+    counts = np.zeros(N_channels, dtype=np.int64)
+    indexes = [np.empty(0, dtype=np.int64)]
+    for channel in sorted(set(channels)):
+        if channel >= N_channels:
+            continue
+
+        start = channel_starts[channel]
+        group_qlongs = qlongs[start:channel_starts[channel + 1]]
+        group_PSDs = PSDs[start:channel_starts[channel + 1]]
+
+        accepted = ((energy_min < group_qlongs) & (group_qlongs < energy_max)
+                    & (PSD_min < group_PSDs) & (group_PSDs < PSD_max))
+
+        indexes.append(np.flatnonzero(accepted) + start)
+        counts[channel] = len(indexes[-1])
+
+    indexes = np.concatenate(indexes)
+
+    selected_starts = np.zeros(N_channels + 1, dtype=np.int64)
+    np.cumsum(counts, out=selected_starts[1:])
+
+    return selected_starts, timestamps[indexes], qlongs[indexes], PSDs[indexes]
+
+def find_coincidences(channel_starts, timestamps, qlongs, PSDs,
+                      owned_min, owned_max, settings):
+
+    # Every event is cut once here, and not once per neighbour in the kernel
+    events_a = select_events(channel_starts, timestamps, qlongs, PSDs, settings['channels_a'], group_cuts(settings, 'a'))
+    events_b = select_events(channel_starts, timestamps, qlongs, PSDs, settings['channels_b'], group_cuts(settings, 'b'))
+
+    # All (ch_a, ch_b) pairs are found in the same call
+    return process_data(*events_a,
+                        *events_b,
+                        settings['offsets'], settings['pair_mask'],
+                        settings['time_min'], settings['time_max'],
+                        owned_min, owned_max)
+
+def chunk_location(task):
+
+    # Where a chunk starts, to find it again after an error
+    if len(task) == 5:
+        file_name, start, stop, owned_min, owned_max = task
+        return {'file':file_name, 'byte_offset':int(start) * event_PSD_dtype.itemsize, 'events':int(stop - start)}
+
+    cache_folder, owned_min, owned_max = task
+    return {'cache_folder':cache_folder, 'time_from':float(owned_min)}
+
+# =============================================================================
+# Cache
+# =============================================================================
+
+def cache_folder_name(file_name):
+    return os.path.splitext(file_name)[0] + '_cache'
+
+def cache_key(file_name, ns_per_sample):
+
+    # A changed file gets a new size or modification time
+    file_stat = os.stat(file_name)
+
+    return {
+        'file_size':file_stat.st_size,
+        'file_mtime':file_stat.st_mtime,
+        'ns_per_sample':ns_per_sample,
+        }
+
+def read_cache_info(cache_folder):
+    try:
+        with open(os.path.join(cache_folder, 'cache_info.json'), 'r') as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def cache_column_name(cache_folder, channel, column):
+    return os.path.join(cache_folder, 'ch{:d}_{}.npy'.format(channel, column))
+
+def build_cache(file_name, ns_per_sample, events_per_chunk):
+
+    cache_folder = cache_folder_name(file_name)
+    os.makedirs(cache_folder, exist_ok=True)
+
+    # Without the info file a half written cache is never used
+    info_name = os.path.join(cache_folder, 'cache_info.json')
+    if os.path.exists(info_name):
+        os.remove(info_name)
+
+    mapped_data = map_events(file_name)
+
+    # First pass, how many events with positive energy in each channel
+    counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, len(mapped_data), events_per_chunk):
+        data = mapped_data[start:start + events_per_chunk]
+        counts += np.bincount(data['channel'][data['qlong'] > 0], minlength=256)
+
+    channels = [int(channel) for channel in np.flatnonzero(counts)]
+
+    columns = dict()
+    for channel in channels:
+        columns[channel] = dict()
+        for column, column_dtype in cache_columns:
+            columns[channel][column] = np.lib.format.open_memmap(cache_column_name(cache_folder, channel, column),
+                                                                 mode='w+', dtype=column_dtype,
+                                                                 shape=(int(counts[channel]),))
+
+    # Second pass, copy every channel into its own columns
+    filled = np.zeros(256, dtype=np.int64)
+    for start in range(0, len(mapped_data), events_per_chunk):
+        data = mapped_data[start:start + events_per_chunk]
+        data = data[data['qlong'] > 0]
+
+        order, channel_starts = build_channel_index(data['channel'], 256)
+        grouped_data = data[order]
+
+        qlongs = grouped_data['qlong']
+        qshorts = grouped_data['qshort']
+
+        for channel in channels:
+            group = slice(channel_starts[channel], channel_starts[channel + 1])
+            destination = slice(filled[channel], filled[channel] + group.stop - group.start)
+
+            columns[channel]['timestamp'][destination] = grouped_data['timestamp'][group] * ns_per_sample
+            columns[channel]['qlong'][destination] = qlongs[group]
+            columns[channel]['qshort'][destination] = qshorts[group]
+            columns[channel]['PSD'][destination] = (qlongs[group].astype(np.float64) - qshorts[group]) / qlongs[group]
+
+            filled[channel] = destination.stop
+
+    # Every channel sorted in time, the digitizer mostly is already
+    for channel in channels:
+        timestamps = columns[channel]['timestamp']
+
+        out_of_order = count_out_of_order(timestamps)
+        if out_of_order > 0:
+            print("    Channel {:d} has {:d} events out of order, sorting".format(channel, out_of_order))
+            order = np.argsort(timestamps, kind='stable')
+            for column, column_dtype in cache_columns:
+                columns[channel][column][:] = columns[channel][column][order]
+
+        for column, column_dtype in cache_columns:
+            columns[channel][column].flush()
+
+    del columns
+
+    cache_info = cache_key(file_name, ns_per_sample)
+    cache_info['events'] = {str(channel):int(counts[channel]) for channel in channels}
+
+    with open(info_name, 'w') as json_file:
+        json.dump(cache_info, json_file, indent=4)
+
+    return cache_folder
+
+def prepare_cache(file_name, ns_per_sample, events_per_chunk):
+
+    cache_folder = cache_folder_name(file_name)
+    cache_info = read_cache_info(cache_folder)
+
+    # Only use the cache if it was made from this very file
+    if cache_info is not None:
+        key = cache_key(file_name, ns_per_sample)
+        if all(cache_info.get(name) == value for name, value in key.items()):
+            print("Using cache: {}".format(cache_folder))
+            return cache_folder
+
+    print("Building cache: {}".format(cache_folder))
+    return build_cache(file_name, ns_per_sample, events_per_chunk)
+
+def load_cache(cache_folder):
+
+    cache_info = read_cache_info(cache_folder)
+
+    # Memory mapped, only what is used gets read
+    cache = dict()
+    for channel in cache_info['events']:
+        cache[int(channel)] = {column:np.load(cache_column_name(cache_folder, int(channel), column), mmap_mode='r')
+                               for column, column_dtype in cache_columns}
+
+    return cache
+
+def make_cached_slices(cache_folder, events_per_chunk, settings):
+
+    cache = load_cache(cache_folder)
+    used_channels = [channel for channel in settings['channels_a'] + settings['channels_b'] if channel in cache]
+
+    if len(used_channels) == 0:
+        return []
+
+    events_number = sum(len(cache[channel]['timestamp']) for channel in used_channels)
+    slices_number = max(int(np.ceil(events_number / events_per_chunk)), 1)
+
+    # Edges at even steps in the busiest channel, about equal slices
+    busiest = max(used_channels, key=lambda channel: len(cache[channel]['timestamp']))
+    busiest_timestamps = cache[busiest]['timestamp']
+    edge_indexes = np.linspace(0, len(busiest_timestamps), slices_number + 1).astype(np.int64)[1:-1]
+
+    edges = np.concatenate(([-np.inf], busiest_timestamps[edge_indexes], [np.inf]))
+
+    return [(cache_folder, edges[i_slice], edges[i_slice + 1]) for i_slice in range(slices_number)]
+
+def process_cached_slice(task, settings):
+
+    cache_folder, owned_min, owned_max = task
+
+    time_start = time.perf_counter()
+
+    cache = load_cache(cache_folder)
+    N_channels = settings['N_channels']
+    time_margin = settings['time_margin']
+    used_channels = set(settings['channels_a'] + settings['channels_b'])
+
+    # Every channel is already sorted, take what is in reach of the owned range
+    parts = []
+    counts = np.zeros(N_channels, dtype=np.int64)
+    for channel in range(N_channels):
+        if channel not in cache or channel not in used_channels:
+            continue
+
+        channel_timestamps = cache[channel]['timestamp']
+        first = np.searchsorted(channel_timestamps, owned_min - time_margin, side='left')
+        last = np.searchsorted(channel_timestamps, owned_max + time_margin, side='right')
+
+        parts.append({column:cache[channel][column][first:last] for column in ('timestamp', 'qlong', 'PSD')})
+        counts[channel] = last - first
+
+    channel_starts = np.zeros(N_channels + 1, dtype=np.int64)
+    np.cumsum(counts, out=channel_starts[1:])
+
+    # The cache is sorted and selected, no event can come late
+    stats = {
+        'events':int(channel_starts[-1]),
+        'late_events':0,
+        'out_of_order':0,
+        'bytes':0,
+        'read_time':0.0,
+        'select_time':0.0,
+        'sort_time':0.0,
+        'kernel_time':0.0,
+        }
+
+    if len(parts) == 0:
+        stats['read_time'] = time.perf_counter() - time_start
+        return np.empty(0, dtype=coincidence_dtype), stats
+
+    timestamps = np.concatenate([part['timestamp'] for part in parts])
+    qlongs = np.concatenate([part['qlong'] for part in parts])
+    PSDs = np.concatenate([part['PSD'] for part in parts])
+    time_read = time.perf_counter()
+
+    new_event_chunk = find_coincidences(channel_starts, timestamps, qlongs, PSDs,
+                                        owned_min, owned_max, settings)
+
+    stats['bytes'] = timestamps.nbytes + qlongs.nbytes + PSDs.nbytes
+    stats['read_time'] = time_read - time_start
+    stats['kernel_time'] = time.perf_counter() - time_read
+
+    return new_event_chunk, stats
+
+# =============================================================================
+# Histograms
+# =============================================================================
+
+def make_bin_edges(value_min, value_max, value_res):
+    bins_number = int(round((value_max - value_min) / value_res))
+    return np.linspace(value_min, value_max, bins_number + 1)
+
+def make_histograms(pairs, time_edges, energy_edges, PSD_edges):
+
+    N_pairs = len(pairs)
+    N_time = len(time_edges) - 1
+    N_energy = len(energy_edges) - 1
+    N_PSD = len(PSD_edges) - 1
+
+    # Energy and PSD are the ones of the a detector
+    return {
+        'pairs':np.array(pairs, dtype=np.uint8).reshape(N_pairs, 2),
+        'time_edges':time_edges,
+        'energy_edges':energy_edges,
+        'PSD_edges':PSD_edges,
+        'ToF':np.zeros((N_pairs, N_time), dtype=np.uint32),
+        'energy_vs_ToF':np.zeros((N_pairs, N_energy, N_time), dtype=np.uint32),
+        'PSD_vs_energy':np.zeros((N_pairs, N_PSD, N_energy), dtype=np.uint32),
+        }
+
+def bin_indexes(values, edges):
+
+    # Index of the bin of every value, -1 when outside all bins
+    indexes = np.searchsorted(edges, values, side='right') - 1
+    indexes[(indexes < 0) | (indexes >= len(edges) - 1)] = -1
+    return indexes
+
+def add_counts(histogram, indexes, valid):
+
+    # Count the filled bins first, the histograms are much larger than a chunk
+    flat_indexes = np.ravel_multi_index(tuple(index[valid] for index in indexes), histogram.shape)
+    filled_bins, counts = np.unique(flat_indexes, return_counts=True)
+    histogram.flat[filled_bins] += counts.astype(histogram.dtype)
+
+def pair_indexes_of(pairs, coincidences):
+
+    # Which histogram every coincidence goes in, -1 for other pairs
+    pair_index = np.full((256, 256), -1, dtype=np.int64)
+    pair_index[pairs[:, 0], pairs[:, 1]] = np.arange(len(pairs))
+
+    return pair_index[coincidences['channel_a'], coincidences['channel_b']]
+
+def fill_histograms(histograms, coincidences):
+
+    pair_indexes = pair_indexes_of(histograms['pairs'], coincidences)
+    time_indexes = bin_indexes(coincidences['ToF'], histograms['time_edges'])
+    energy_indexes = bin_indexes(coincidences['energy_a'], histograms['energy_edges'])
+    PSD_indexes = bin_indexes(coincidences['PSD_a'], histograms['PSD_edges'])
+
+    has_pair = pair_indexes >= 0
+    has_time = has_pair & (time_indexes >= 0)
+
+    add_counts(histograms['ToF'], (pair_indexes, time_indexes), has_time)
+    add_counts(histograms['energy_vs_ToF'], (pair_indexes, energy_indexes, time_indexes), has_time & (energy_indexes >= 0))
+    add_counts(histograms['PSD_vs_energy'], (pair_indexes, PSD_indexes, energy_indexes), has_pair & (energy_indexes >= 0) & (PSD_indexes >= 0))
+
+# =============================================================================
+# Calibration
+# =============================================================================
+
+def make_ToF_histograms(pairs, time_edges):
+    return {
+        'pairs':np.array(pairs, dtype=np.uint8).reshape(len(pairs), 2),
+        'time_edges':time_edges,
+        'ToF':np.zeros((len(pairs), len(time_edges) - 1), dtype=np.uint32),
+        }
+
+def fill_ToF_histograms(histograms, coincidences):
+
+    # Only the ToF, so that all pairs fit in memory with a fine time binning
+    pair_indexes = pair_indexes_of(histograms['pairs'], coincidences)
+    time_indexes = bin_indexes(coincidences['ToF'], histograms['time_edges'])
+
+    add_counts(histograms['ToF'], (pair_indexes, time_indexes), (pair_indexes >= 0) & (time_indexes >= 0))
+
+def gaussian_background(x, A, mu, sigma, background):
+    return A * np.exp(-(x - mu)**2 / (2 * sigma**2)) + background
+
+def fit_prompt_peak(time_edges, counts, fit_width, min_counts, min_significance):
+
+    # Gaussian on a flat background around the highest bin, in units of ns
+    time_centers = (time_edges[:-1] + time_edges[1:]) / 2
+    time_step = time_edges[1] - time_edges[0]
+
+    peak = np.argmax(counts)
+    window = np.abs(time_centers - time_centers[peak]) <= fit_width
+    x = time_centers[window]
+    y = counts[window].astype(np.float64)
+
+    # Random coincidences are flat, the median outside the window is their level
+    outside = counts[~window]
+    background = np.median(outside) if len(outside) > 0 else 0.0
+    peak_counts = np.sum(y) - background * len(y)
+
+    # On a high background the highest bin can be a fluctuation
+    if peak_counts < min_counts or peak_counts < min_significance * np.sqrt(max(background * len(y), 1)):
+        return None
+
+    sigma_guess = max(peak_counts / (y.max() - background) / np.sqrt(2 * np.pi), time_step)
+    p0 = [y.max() - background, time_centers[peak], sigma_guess, background]
+
+    try:
+        popt, pcov = curve_fit(gaussian_background, x, y, p0=p0, sigma=np.sqrt(np.maximum(y, 1)))
+    except (RuntimeError, ValueError):
+        return None
+
+    A, mu, sigma, background = popt
+    mu_error = np.sqrt(pcov[1, 1])
+
+    # A fit that ran away from the peak is as bad as no fit
+    if not (A > 0 and np.isfinite(mu_error) and abs(mu - time_centers[peak]) < fit_width):
+        return None
+
+    return {
+        'offset':float(mu),
+        'offset_error':float(mu_error),
+        'sigma':float(abs(sigma)),
+        'peak_counts':float(peak_counts),
+        'background':float(background),
+        }
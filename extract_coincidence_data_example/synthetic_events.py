@@ -0,0 +1,121 @@
+# Elias Arnqvist
+
+"""
+Synthetic ABCD .ade event files with known coincidences, to measure the
+extraction without detector data.
+
+Every channel gets random events at its own rate. A fraction of the events in
+the a channels get a partner in one of the b channels, at the ToF offset of
+the pair plus a Gaussian spread. Those pairs are the ground truth, in the
+coincidence_dtype of coincidence_functions, with the ToF calculated the same
+way as in process_data. The events are written in time order, except for a
+random delay of up to jitter ns, as the digitizer does between channels.
+"""
+
+import numpy as np
+
+from coincidence_functions import event_PSD_dtype, coincidence_dtype, group_cuts
+
+def random_events(rng, channel, events_number, duration, ns_per_sample):
+
+    events = np.zeros(events_number, dtype=event_PSD_dtype)
+    events['timestamp'] = rng.uniform(0, duration, events_number) / ns_per_sample
+    events['channel'] = channel
+
+    # qlong from 1, so that all events pass the selection of positive energy
+    events['qlong'] = rng.integers(1, 65536, events_number)
+    events['qshort'] = events['qlong'] * rng.uniform(0.5, 1, events_number)
+
+    return events
+
+def generate_events(rates, duration, channels_a, channels_b, offsets,
+                    coincidence_fraction, ToF_sigma, jitter, ns_per_sample, seed=0):
+    """
+    rates in events per second per channel, {channel: rate}, and duration in
+    ns. offsets[ch_a, ch_b] is the ToF offset of a pair in ns.
+    Returns the events in file order and the injected coincidences.
+    """
+    rng = np.random.default_rng(seed)
+
+    parts = []
+    for channel, rate in rates.items():
+        parts.append(random_events(rng, channel, rng.poisson(rate * duration * 1e-9), duration, ns_per_sample))
+
+    # Partners for a fraction of the a events
+    truth_a = []
+    truth_b = []
+    for ch_a in channels_a:
+        events_a = parts[list(rates).index(ch_a)]
+        with_partner = events_a[rng.random(len(events_a)) < coincidence_fraction]
+
+        ch_b = rng.choice(channels_b, len(with_partner))
+        partners = random_events(rng, 0, len(with_partner), duration, ns_per_sample)
+        partners['channel'] = ch_b
+
+        # Partners before the start of the file are left out
+        partner_times = with_partner['timestamp'] * ns_per_sample + offsets[ch_a, ch_b] + rng.normal(0, ToF_sigma, len(with_partner))
+        keep = partner_times > 0
+        partners = partners[keep]
+        partners['timestamp'] = partner_times[keep] / ns_per_sample
+
+        truth_a.append(with_partner[keep])
+        truth_b.append(partners)
+        parts.append(partners)
+
+    events = np.concatenate(parts)
+
+    # Time order, with every event up to jitter ns late
+    write_times = events['timestamp'] * ns_per_sample + rng.uniform(0, jitter, len(events))
+    events = events[np.argsort(write_times, kind='stable')]
+
+    return events, make_truth(np.concatenate(truth_a), np.concatenate(truth_b), offsets, ns_per_sample)
+
+def make_truth(events_a, events_b, offsets, ns_per_sample):
+
+    truth = np.zeros(len(events_a), dtype=coincidence_dtype)
+    truth['channel_a'] = events_a['channel']
+    truth['channel_b'] = events_b['channel']
+    truth['energy_a'] = events_a['qlong']
+    truth['energy_b'] = events_b['qlong']
+    truth['PSD_a'] = (events_a['qlong'].astype(np.float64) - events_a['qshort']) / events_a['qlong']
+    truth['PSD_b'] = (events_b['qlong'].astype(np.float64) - events_b['qshort']) / events_b['qlong']
+
+    # Same operations as in process_data, so that the float32 values are equal
+    truth['ToF'] = (events_b['timestamp'] * ns_per_sample - events_a['timestamp'] * ns_per_sample
+                    - offsets[events_a['channel'], events_b['channel']])
+
+    return truth
+
+def write_events(file_name, events):
+    events.astype(event_PSD_dtype).tofile(file_name)
+
+def coincidence_keys(coincidences):
+
+    # One bytes key per row, for comparing found and injected coincidences
+    return np.ascontiguousarray(coincidences).view(np.dtype((np.void, coincidence_dtype.itemsize)))
+
+def compare_with_truth(found, truth, settings):
+    """
+    How many of the injected coincidences that pass the cuts of settings are
+    found, and how many found rows are there more than once.
+    """
+    accepted = settings['pair_mask'][truth['channel_a'], truth['channel_b']]
+    accepted &= (settings['time_min'] < truth['ToF']) & (truth['ToF'] < settings['time_max'])
+
+    for group in ('a', 'b'):
+        energy_min, energy_max, PSD_min, PSD_max = group_cuts(settings, group)
+        energies = truth['energy_' + group]
+        PSDs = truth['PSD_' + group]
+        accepted &= (energy_min < energies) & (energies < energy_max) & (PSD_min < PSDs) & (PSDs < PSD_max)
+
+    expected = truth[accepted]
+
+    found_keys, found_counts = np.unique(coincidence_keys(found), return_counts=True)
+    expected_keys = np.unique(coincidence_keys(expected))
+
+    return {
+        'expected':len(expected),
+        'found':int(np.count_nonzero(np.isin(expected_keys, found_keys))),
+        'missed':int(np.count_nonzero(~np.isin(expected_keys, found_keys))),
+        'duplicates':int(np.sum(found_counts - 1)),
+        }
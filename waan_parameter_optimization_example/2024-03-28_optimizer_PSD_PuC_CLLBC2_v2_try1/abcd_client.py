@@ -0,0 +1,248 @@
+
+"""
+Spring 2024
+Elias Arnqvist
+
+Asyncio client for the ABCD modules that the optimizer talks to: waan, spec
+and tofcalc. Every module has a command socket and the subscribed data or
+status socket. A reader task puts the messages in one queue per topic, so
+that several pipelines can be used at the same time from one process. The
+queues only keep the newest messages, QUEUE_LENGTHS, older ones are dropped
+as by the high water mark of ZeroMQ, so topics that are not read do not
+fill the memory.
+
+The reader only stores the raw bytes. The JSON is parsed by payload(), when
+the message is used, so histograms that are superseded before they are read
+are never parsed.
+
+A pipeline is a dict with one module per name. Instance i has all ports
+moved up by i * port_stride, as in the startup script.
+"""
+
+import asyncio
+import collections
+import datetime
+import itertools
+
+import zmq
+import zmq.asyncio
+
+# orjson is several times faster on the large histograms, if it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+from json import dumps as json_dumps
+
+# Topics that are subscribed to for every module
+TOPICS = {"waan": ("status_waan", "events_waan"),
+          "spec": ("data_spec_histograms",),
+          "tofcalc": ("data_tofcalc_histograms",),
+          }
+
+# Topic with the histograms of the modules that make histograms
+HISTOGRAMS_TOPICS = {"spec": "data_spec_histograms",
+                     "tofcalc": "data_tofcalc_histograms",
+                     }
+
+# Topic with the events of the modules, e.g. the reconfiguration of waan
+EVENTS_TOPICS = {"waan": "events_waan"}
+
+# Messages kept per topic, only the newest histogram or status is ever used
+QUEUE_LENGTH = 1
+# Events are all looked at, a few can come at once
+QUEUE_LENGTHS = {"events_waan": 16}
+
+# Shared by all modules, as the IDs only have to be unique
+msg_IDs = itertools.count()
+
+# =============================================================================
+# Modules
+# =============================================================================
+
+def instance_address(address, instance, port_stride):
+    # Same address, with the port of the given instance
+    address_start, port = address.rsplit(':', 1)
+    return "{}:{:d}".format(address_start, int(port) + instance * port_stride)
+
+
+def open_module(context, commands_address, subscribe_address, topics):
+    module = dict()
+    module["socket_commands"] = context.socket(zmq.PUSH)
+    module["socket_commands"].connect(commands_address)
+
+    module["socket_subscribe"] = context.socket(zmq.SUB)
+    module["socket_subscribe"].connect(subscribe_address)
+    for topic in topics:
+        module["socket_subscribe"].setsockopt(zmq.SUBSCRIBE, topic.encode("ascii"))
+
+    module["queues"] = {topic: collections.deque(maxlen=QUEUE_LENGTHS.get(topic, QUEUE_LENGTH)) for topic in topics}
+    module["new_messages"] = {topic: asyncio.Event() for topic in topics}
+    module["prefixes"] = {topic.encode("ascii"): topic for topic in topics}
+    module["last"] = {topic: None for topic in topics}
+    module["reader"] = asyncio.ensure_future(read_messages(module))
+
+    return module
+
+
+async def read_messages(module):
+    # Runs until it is cancelled by close_module()
+    while True:
+        message = await module["socket_subscribe"].recv()
+        topic, raw = message.split(b' ', 1)
+        now = datetime.datetime.now()
+
+        for prefix, name in module["prefixes"].items():
+            if topic.startswith(prefix):
+                module["queues"][name].append({"timestamp": now, "topic": topic.decode('ascii', 'ignore'), "raw": raw})
+                module["new_messages"][name].set()
+
+
+def payload(message):
+    # Parsed only once, and only for the messages that are used
+    if "payload" not in message:
+        message["payload"] = json_loads(message["raw"])
+        del message["raw"]
+    return message["payload"]
+
+
+async def close_module(module):
+    module["reader"].cancel()
+    try:
+        await module["reader"]
+    except asyncio.CancelledError:
+        pass
+
+    module["socket_commands"].close(linger=0)
+    module["socket_subscribe"].close(linger=0)
+
+
+async def send_command(module, command, arguments):
+    message = dict()
+    message["msg_ID"] = next(msg_IDs)
+    message["timestamp"] = datetime.datetime.now().isoformat()
+    message["command"] = command
+    message["arguments"] = arguments
+
+    await module["socket_commands"].send(json_dumps(message).encode('ascii'))
+
+
+def latest_message(module, topic):
+    # Newest message of the topic, without waiting, older ones are dropped unparsed
+    queue = module["queues"][topic]
+    if queue:
+        module["last"][topic] = queue[-1]
+        queue.clear()
+    return module["last"][topic]
+
+
+async def next_message(module, topic, timeout, accept=lambda payload: True):
+    # Next new message that accept() is true for, None after timeout seconds
+    # Rejected messages are dropped, they are never given out as the last one
+    queue = module["queues"][topic]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    while True:
+        while not queue:
+            module["new_messages"][topic].clear()
+            try:
+                await asyncio.wait_for(module["new_messages"][topic].wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return None
+
+        message = queue.popleft()
+        if accept(payload(message)):
+            module["last"][topic] = message
+            return message
+
+# =============================================================================
+# Pipelines
+# =============================================================================
+
+async def open_pipeline(context, addresses, instance, port_stride):
+    """
+    addresses has the commands and subscribe addresses of every module, as
+    {"waan": (commands, status), "spec": (commands, data), ...}.
+    """
+    pipeline = dict()
+    pipeline["instance"] = instance
+
+    for name, (commands_address, subscribe_address) in addresses.items():
+        pipeline[name] = open_module(context,
+                                     instance_address(commands_address, instance, port_stride),
+                                     instance_address(subscribe_address, instance, port_stride),
+                                     TOPICS[name])
+
+    return pipeline
+
+
+async def wait_subscribed(pipeline, timeout, name="waan"):
+    """
+    Waits for the first status of the module. Messages that are published
+    before the subscription is set up are lost, also the events that
+    reconfigure() waits for. None after timeout seconds.
+    """
+    return await next_message(pipeline[name], TOPICS[name][0], timeout)
+
+
+async def close_pipeline(pipeline):
+    for name in TOPICS:
+        if name in pipeline:
+            await close_module(pipeline[name])
+
+
+def is_reconfiguration_event(payload):
+    return "reconfigur" in str(payload.get("event", "")).lower()
+
+
+async def reconfigure(pipeline, config, timeout, name="waan", delay=None):
+    """
+    Sends the new config and waits for the reconfiguration event, that the
+    module publishes on its status socket after it has applied the config.
+    None if the event does not come within timeout seconds.
+
+    With a module that does not publish the event nothing confirms the
+    command. Then give delay, and the config is assumed to be applied after
+    delay seconds, which has to be long enough for the busiest module.
+    """
+    module = pipeline[name]
+
+    if delay is not None:
+        await send_command(module, "reconfigure", {"config": config})
+        await asyncio.sleep(delay)
+        return {"event": "delay"}
+
+    topic = EVENTS_TOPICS[name]
+    latest_message(module, topic)
+
+    await send_command(module, "reconfigure", {"config": config})
+
+    return await next_message(module, topic, timeout, is_reconfiguration_event)
+
+
+def is_empty_spectrum(payload):
+    return all(sum(channel["energy"]["data"]) == 0 for channel in payload["data"])
+
+
+async def reset(pipeline, timeout, name="spec", accept=is_empty_spectrum):
+    """
+    Resets all channels and waits for the first histograms after the reset.
+    Histograms from before are never given out after this, also not when it
+    times out and returns None.
+    """
+    module = pipeline[name]
+    latest_message(module, HISTOGRAMS_TOPICS[name])
+    module["last"][HISTOGRAMS_TOPICS[name]] = None
+
+    await send_command(module, "reset", {"channel": "all"})
+
+    return await next_message(module, HISTOGRAMS_TOPICS[name], timeout, accept)
+
+
+async def next_histogram(pipeline, timeout, name="spec", accept=lambda payload: True):
+    return await next_message(pipeline[name], HISTOGRAMS_TOPICS[name], timeout, accept)
+
+
+def latest_histogram(pipeline, name="spec"):
+    return latest_message(pipeline[name], HISTOGRAMS_TOPICS[name])
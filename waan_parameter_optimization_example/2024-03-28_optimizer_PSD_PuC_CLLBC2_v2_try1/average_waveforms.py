@@ -0,0 +1,296 @@
+"""
+Spring 2024
+Elias Arnqvist
+
+Average waveforms from a raw .adr file, as libPSD_averaging.c makes them in
+waan, so that pregate, short_gate, long_gate and the reg gates can be chosen
+before a scan, without ABCD and a replay.
+
+Every channel is read in batches with the reader of offline_PSD.py, one
+channel per process. For every waveform the baseline, qshort, qlong and PSD
+are calculated as in libPSD_averaging.c, with the trigger positions from
+offline_PSD.find_trigger_positions(). The accepted waveforms minus their
+baseline are averaged, as in the C library, for every energy and PSD band.
+
+The gate profile is the average baseline subtracted integral, from the start
+of the baseline (trigger - pregate - baseline_samples) on. The integral of
+any gate is the difference of two of its values, so gates can be compared
+from it directly.
+
+The results are saved in an .npz file, and the counts and baseline
+statistics of every channel in a .json file.
+"""
+
+import numpy as np
+import json
+import multiprocessing
+
+import offline_PSD
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Raw file to average
+RAW_FILE = "/home/elias/abcd_data/2024-03-14_run1_PuC_20min_8detectors_CLLBC123/2024-03-14T11-48-49_DT5730_PuC_Ch0_CLLBC1_HV-810_Ch1_CLLBC2_HV-760_Ch2_TheBeast_HV700_Ch3_LaBr19.2_HV626_Ch4_LaBr19.4_HV539_Ch5_LaBr19.6_HV539_Ch6_LaBr19.8_HV620_Ch7_CLLBC3_HV790_raw.adr"
+# Gates, baseline and CFD settings of every channel
+CONFIG_FILE = "config_Elias.json"
+# Where to save, .npz and .json are added
+OUTPUT_NAME = "average_waveforms"
+
+# Channels to average, None for all channels in the raw file
+CHANNELS = None
+
+# Bands of scaled qlong and of PSD = (qlong - qshort) / qlong, every
+# combination gets its own average, min <= x < max
+ENERGY_BANDS = [(0, 65536)]
+PSD_BANDS = [(-0.1, 0.2), (0.2, 1.1)]
+
+# Length of the gate profile, in samples from the start of the baseline
+PROFILE_SAMPLES = 2000
+
+# Number of channels done at the same time
+WORKERS = 4
+
+# =============================================================================
+# Functions
+# =============================================================================
+
+def averaging_config(user_config):
+    # Settings of libPSD_averaging.c energy_init(), with the same defaults
+    config = dict()
+    config["baseline_samples"] = int(user_config["baseline_samples"])
+    config["short_pregate"] = int(user_config.get("short_pregate", user_config["pregate"]))
+    config["long_pregate"] = int(user_config.get("long_pregate", user_config["pregate"]))
+    config["short_gate"] = int(user_config["short_gate"])
+    config["long_gate"] = int(user_config["long_gate"])
+    config["integrals_scaling"] = float(user_config.get("integrals_scaling", 1))
+    config["energy_min"] = float(user_config.get("energy_min", 0))
+    config["energy_max"] = float(user_config.get("energy_max", 65535))
+    config["PSD_min"] = float(user_config.get("PSD_min", -0.1))
+    config["PSD_max"] = float(user_config.get("PSD_max", 1.1))
+    config["sign"] = offline_PSD.polarity_sign(user_config)
+    return config
+
+
+def analyse_batch(samples, trigger_positions, config):
+    """
+    Baseline, scaled qlong, PSD, acceptance and the integral curve from
+    local_start of every waveform, as in libPSD_averaging.c energy_analysis().
+    """
+    waveforms_number, samples_number = samples.shape
+    rows = np.arange(waveforms_number)
+    baseline_samples = config["baseline_samples"]
+    global_pregate = max(config["short_pregate"], config["long_pregate"])
+
+    local_start = np.clip(trigger_positions - global_pregate - baseline_samples, 0, samples_number - 1)
+    local_trigger_position = np.clip(trigger_positions - local_start, 0, samples_number - 1)
+    local_end = samples_number - local_start
+
+    baseline_end = np.clip(baseline_samples, 1, local_end)
+
+    gates = dict()
+    for gate in ("short", "long"):
+        gate_start = np.clip(local_trigger_position - config[gate + "_pregate"], 0, local_end - 1)
+        gate_end = np.clip(gate_start + config[gate + "_gate"] - 1, 0, local_end - 1)
+        gates[gate] = (gate_start, gate_end)
+
+    # Every waveform from its local_start, the rest is padded with zeros
+    local_columns = local_start[:, np.newaxis] + np.arange(samples_number)
+    inside = local_columns < samples_number
+    local_samples = np.where(inside, samples[rows[:, np.newaxis], np.minimum(local_columns, samples_number - 1)], 0)
+
+    samples_cumulative = np.cumsum(local_samples.astype(np.uint64), axis=1)
+    baseline = samples_cumulative[rows, baseline_end - 1].astype(np.float64) / baseline_end
+
+    curve_integral = samples_cumulative - baseline[:, np.newaxis] * (np.arange(samples_number) + 1)
+    curve_integral[~inside] = np.nan
+
+    # Noise of the samples that the baseline is made of
+    baseline_window = np.arange(samples_number) < baseline_end[:, np.newaxis]
+    deviations = np.where(baseline_window, local_samples - baseline[:, np.newaxis], 0)
+    baseline_rms = np.sqrt(np.sum(deviations**2, axis=1) / baseline_end)
+
+    integrals = dict()
+    for gate, (gate_start, gate_end) in gates.items():
+        integrals[gate] = curve_integral[rows, gate_end] - curve_integral[rows, np.maximum(gate_start - 2, 0)]
+
+    qshort, qlong = integrals["short"], integrals["long"]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        PSD = np.where(qlong != 0, (qlong - qshort) / qlong, config["PSD_min"] - 1)
+
+    scaled_qlong = qlong * config["integrals_scaling"] * config["sign"]
+
+    accepted = ((scaled_qlong >= config["energy_min"]) & (scaled_qlong <= config["energy_max"])
+                & (PSD >= config["PSD_min"]) & (PSD <= config["PSD_max"]))
+
+    return baseline, baseline_rms, scaled_qlong, PSD, accepted, curve_integral
+
+
+def new_sums(length):
+    return {"counts": 0,
+            "pulse_sum": np.zeros(length),
+            "pulse_sum2": np.zeros(length),
+            "pulse_columns": np.zeros(length, dtype=np.int64),
+            "profile_sum": np.zeros(PROFILE_SAMPLES),
+            "profile_columns": np.zeros(PROFILE_SAMPLES, dtype=np.int64),
+            }
+
+
+def add_to_sums(sums, pulses, profiles):
+    length = pulses.shape[1]
+    sums["counts"] += pulses.shape[0]
+    sums["pulse_sum"][:length] += pulses.sum(axis=0)
+    sums["pulse_sum2"][:length] += (pulses**2).sum(axis=0)
+    sums["pulse_columns"][:length] += pulses.shape[0]
+
+    # The profile ends where the waveform does
+    valid = ~np.isnan(profiles)
+    sums["profile_sum"] += np.where(valid, profiles, 0).sum(axis=0)
+    sums["profile_columns"] += valid.sum(axis=0)
+
+
+def channel_averages(task):
+    """
+    Averages of one channel, for every band, and its baseline statistics.
+    Runs in a worker process, the raw file is mapped again there.
+    """
+    raw_file, channel, user_config, channel_index = task
+
+    raw = offline_PSD.map_raw_file(raw_file)
+    config = averaging_config(user_config)
+    length = int(channel_index['samples_number'].max())
+
+    bands = [(energy_band, PSD_band) for energy_band in ENERGY_BANDS for PSD_band in PSD_BANDS]
+    sums = [new_sums(length) for band in bands]
+
+    baseline_stats = {"waveforms": 0, "sum": 0.0, "sum2": 0.0, "min": np.inf, "max": -np.inf, "rms_sum": 0.0}
+    accepted_number = 0
+
+    for samples in offline_PSD.channel_batches(raw, channel_index, channel):
+        trigger_positions = offline_PSD.find_trigger_positions(samples, user_config)
+        baseline, baseline_rms, scaled_qlong, PSD, accepted, curve_integral = analyse_batch(samples, trigger_positions, config)
+
+        baseline_stats["waveforms"] += len(baseline)
+        baseline_stats["sum"] += baseline.sum()
+        baseline_stats["sum2"] += (baseline**2).sum()
+        baseline_stats["min"] = min(baseline_stats["min"], baseline.min())
+        baseline_stats["max"] = max(baseline_stats["max"], baseline.max())
+        baseline_stats["rms_sum"] += baseline_rms.sum()
+        accepted_number += np.count_nonzero(accepted)
+
+        # As in the C library, the samples minus the baseline, not shifted
+        pulses = samples - baseline[:, np.newaxis]
+
+        profiles = np.full((len(samples), PROFILE_SAMPLES), np.nan)
+        columns = min(PROFILE_SAMPLES, samples.shape[1])
+        profiles[:, :columns] = curve_integral[:, :columns]
+
+        for ((energy_min, energy_max), (PSD_min, PSD_max)), band_sums in zip(bands, sums):
+            in_band = (accepted & (energy_min <= scaled_qlong) & (scaled_qlong < energy_max)
+                       & (PSD_min <= PSD) & (PSD < PSD_max))
+            add_to_sums(band_sums, pulses[in_band], profiles[in_band])
+
+    waveforms = baseline_stats["waveforms"]
+    mean = baseline_stats["sum"] / waveforms if waveforms > 0 else 0.0
+
+    result = dict()
+    result["channel"] = channel
+    result["waveforms"] = waveforms
+    result["accepted"] = accepted_number
+    result["baseline"] = {"mean": mean,
+                          "std": np.sqrt(max(baseline_stats["sum2"] / waveforms - mean**2, 0)) if waveforms > 0 else 0.0,
+                          "min": float(baseline_stats["min"]),
+                          "max": float(baseline_stats["max"]),
+                          "mean_rms": baseline_stats["rms_sum"] / waveforms if waveforms > 0 else 0.0,
+                          }
+    result["bands"] = []
+    for (energy_band, PSD_band), band_sums in zip(bands, sums):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pulse = band_sums["pulse_sum"] / band_sums["pulse_columns"]
+            pulse_std = np.sqrt(np.maximum(band_sums["pulse_sum2"] / band_sums["pulse_columns"] - pulse**2, 0))
+            profile = band_sums["profile_sum"] / band_sums["profile_columns"]
+
+        result["bands"].append({"energy_band": energy_band,
+                                "PSD_band": PSD_band,
+                                "counts": band_sums["counts"],
+                                "pulse": pulse,
+                                "pulse_std": pulse_std,
+                                "profile": profile,
+                                })
+
+    return result
+
+
+def save_results(results):
+    arrays = dict()
+    summary = dict()
+
+    for result in results:
+        channel = result["channel"]
+        summary[str(channel)] = {"waveforms": int(result["waveforms"]),
+                                 "accepted": int(result["accepted"]),
+                                 "baseline": {key: float(value) for key, value in result["baseline"].items()},
+                                 "bands": [],
+                                 }
+
+        for i_band, band in enumerate(result["bands"]):
+            summary[str(channel)]["bands"].append({"energy_band": list(band["energy_band"]),
+                                                   "PSD_band": list(band["PSD_band"]),
+                                                   "counts": int(band["counts"]),
+                                                   })
+            for key in ("pulse", "pulse_std", "profile"):
+                arrays["ch{:d}_band{:d}_{}".format(channel, i_band, key)] = band[key]
+
+    np.savez(OUTPUT_NAME + ".npz", **arrays)
+    with open(OUTPUT_NAME + ".json", 'w') as json_file:
+        json.dump(summary, json_file, indent=4)
+
+# =============================================================================
+# Main
+# =============================================================================
+
+# Worker processes can import this file again, so only run from here
+if __name__ == '__main__':
+    with open(CONFIG_FILE) as config_file:
+        config = json.load(config_file)
+
+    user_configs = {channel["id"]: channel["user_config"] for channel in config["channels"] if "id" in channel}
+
+    print("Indexing raw file: {}".format(RAW_FILE))
+    raw = offline_PSD.map_raw_file(RAW_FILE)
+    index = offline_PSD.index_waveforms(raw)
+    del raw
+
+    channels = CHANNELS if CHANNELS is not None else [int(channel) for channel in np.unique(index['channel'])]
+    print("Waveforms: {:d}, channels: {}".format(len(index), channels))
+
+    # Every worker only gets the index of its own channel
+    tasks = []
+    for channel in channels:
+        if channel not in user_configs:
+            print("WARNING: No config for channel {:d}, skipping it".format(channel))
+            continue
+
+        channel_index = index[index['channel'] == channel]
+        if len(channel_index) == 0:
+            print("WARNING: No waveforms of channel {:d}, skipping it".format(channel))
+            continue
+
+        tasks.append((RAW_FILE, channel, user_configs[channel], channel_index))
+
+    if WORKERS > 1:
+        with multiprocessing.Pool(min(WORKERS, len(tasks))) as pool:
+            results = pool.map(channel_averages, tasks)
+    else:
+        results = [channel_averages(task) for task in tasks]
+
+    for result in results:
+        print("Channel {:d}: waveforms: {:d}, accepted: {:d}".format(result["channel"], result["waveforms"], result["accepted"]))
+        print("    baseline: {mean:.2f} +- {std:.2f}, noise rms: {mean_rms:.2f}".format(**result["baseline"]))
+        for band in result["bands"]:
+            print("    energy {}, PSD {}: {:d} waveforms".format(band["energy_band"], band["PSD_band"], band["counts"]))
+
+    save_results(results)
+
+    print("Saved: {}.npz and {}.json".format(OUTPUT_NAME, OUTPUT_NAME))
@@ -0,0 +1,109 @@
+"""
+Spring 2024
+Elias Arnqvist
+
+Checks that offline_PSD.py gives the same spectra as waan and spec. Points
+that the optimizer has replayed online are in its result store, these are
+calculated again offline from the same raw file and config and compared bin
+by bin.
+
+The trigger positions of offline_PSD.py come from its own CFD, not from
+libCFD, and zero_crossing_samples, fractional_bits and disable_shift are not
+used. Differences here are most likely from that.
+
+The settings have to be the ones of the online scan, so that the online
+store is found. The report is saved as comparison.json in its folder.
+"""
+
+import os
+import json
+
+import offline_PSD
+import result_store
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Same as in run_optimizer_PSD_p1.py
+RAW_FILE = "/home/elias/abcd_data/2024-03-14_run1_PuC_20min_8detectors_CLLBC123/2024-03-14T11-48-49_DT5730_PuC_Ch0_CLLBC1_HV-810_Ch1_CLLBC2_HV-760_Ch2_TheBeast_HV700_Ch3_LaBr19.2_HV626_Ch4_LaBr19.4_HV539_Ch5_LaBr19.6_HV539_Ch6_LaBr19.8_HV620_Ch7_CLLBC3_HV790_raw.adr"
+CONFIG_FILE = "config_Elias.json"
+SPEC_FILE = "spec_Elias.json"
+RESULTS_FOLDER = "PSD_spectra/"
+CHANNEL = 1
+CHANNELS_INDEX = 1
+
+# Points to compare as (reg1, reg2, dist1, dist2), None for all in the online store
+POINTS = None
+
+# =============================================================================
+# Functions
+# =============================================================================
+
+# Region start and stop, as sent to waan by the optimizer
+def regions_from_parameters(reg1, reg2, dist1, dist2):
+    reg1_start = dist1
+    reg1_stop = dist1 + reg1
+    reg2_start = dist1 + reg1 + dist2
+    reg2_stop = dist1 + reg1 + dist2 + reg2
+    return reg1_start, reg1_stop, reg2_start, reg2_stop
+
+# =============================================================================
+# Main
+# =============================================================================
+
+with open(CONFIG_FILE) as config_file:
+    config = json.load(config_file)
+with open(SPEC_FILE) as spec_file:
+    spec_config = json.load(spec_file)
+
+description = result_store.describe_run(RAW_FILE, config, spec_config, CHANNELS_INDEX, CHANNEL, False)
+online_folder = result_store.run_folder(RESULTS_FOLDER, description)
+
+if not os.path.exists(online_folder):
+    raise FileNotFoundError("No online store for these settings: {}".format(online_folder))
+
+store = result_store.open_store(online_folder)
+
+points = sorted(store["index"]) if POINTS is None else [tuple(point) for point in POINTS]
+missing = [point for point in points if point not in store["index"]]
+for point in missing:
+    print("WARNING: No online spectra of {}, skipping it".format(point))
+points = [point for point in points if point not in missing]
+
+print("Online store: {}".format(online_folder))
+print("Points to compare: {:d}".format(len(points)))
+
+user_config = config['channels'][CHANNELS_INDEX]['user_config']
+spec_channel = description["spec_channel"]
+energies, PSDs = offline_PSD.histogram_bins(spec_channel)
+regions = [regions_from_parameters(*point) for point in points]
+
+report = dict()
+i_point = 0
+for pass_regions, energy_counts, counts2d in offline_PSD.evaluate_grid(RAW_FILE, CHANNEL, user_config, spec_channel, regions):
+    for i_region in range(len(pass_regions)):
+        point = points[i_point]
+        i_point += 1
+
+        comparison = offline_PSD.compare_spectra((energies, PSDs, energy_counts[i_region], counts2d[i_region]),
+                                                 result_store.read_spectra(store, point))
+        report[",".join(str(parameter) for parameter in point)] = comparison
+
+        if comparison["identical"]:
+            print("{}: identical".format(point))
+        elif not comparison["same_bins"]:
+            print("{}: DIFFERENT bins of the spectra".format(point))
+        else:
+            print("{}: DIFFERENT, energy: {:d} bins, max {:d}, counts {:d} offline / {:d} online".format(
+                point, comparison["energy_counts"]["differing_bins"], comparison["energy_counts"]["largest_difference"],
+                comparison["energy_counts"]["offline_counts"], comparison["energy_counts"]["online_counts"]))
+            print("    PSD vs energy: {:d} bins, max {:d}, counts {:d} offline / {:d} online".format(
+                comparison["counts2d"]["differing_bins"], comparison["counts2d"]["largest_difference"],
+                comparison["counts2d"]["offline_counts"], comparison["counts2d"]["online_counts"]))
+
+identical = sum(comparison["identical"] for comparison in report.values())
+print("Identical points: {:d} of {:d}".format(identical, len(report)))
+
+with open(os.path.join(online_folder, "comparison.json"), 'w') as file:
+    json.dump(report, file, indent=4)
@@ -0,0 +1,386 @@
+
+"""
+Spring 2024
+Elias Arnqvist
+
+Offline version of the PSD calculation in libPSD_Elias.c, so that gate
+settings can be tried without replaying the raw file through waan and spec.
+
+The raw .adr file is a sequence of ABCD messages. Every message is a topic,
+that ends with the payload size as _s<size>, a space and then the payload.
+The payload of a data_abcd_waveforms topic is a sequence of waveforms:
+    timestamp (uint64), channel (uint8), samples_number (uint32),
+    additional_waveforms (uint8), samples (uint16 * samples_number),
+    additional (uint8 * samples_number * additional_waveforms)
+
+The file is memory mapped and every waveform is only read when used.
+
+The trigger position comes from libCFD in waan, which is not in this folder.
+It is calculated here from the same settings in find_trigger_positions(),
+but zero_crossing_samples, fractional_bits and disable_shift are not used.
+The integrals are done exactly as in libPSD_Elias.c, so the results are the
+same as from waan as long as the trigger positions are. Check that with
+compare_offline_online.py against the points of an online scan.
+"""
+
+import numpy as np
+from numba import jit
+
+# Size of the waveform header before the samples
+WAVEFORM_HEADER_SIZE = 8 + 1 + 4 + 1
+
+# Topic of the messages with waveforms
+WAVEFORMS_TOPIC = "data_abcd_waveforms"
+
+# Waveforms per batch, limits the memory used
+BATCH_SIZE = 10000
+
+# Memory for the histograms of the grid points in one pass over the file
+MAX_HISTOGRAM_BYTES = 2 * 1024**3
+
+waveform_index_dtype = np.dtype([('offset', np.int64),
+                                 ('timestamp', np.uint64),
+                                 ('channel', np.uint8),
+                                 ('samples_number', np.uint32),
+                                 ])
+
+# =============================================================================
+# Reading
+# =============================================================================
+
+def map_raw_file(file_name):
+    return np.memmap(file_name, dtype=np.uint8, mode='r')
+
+
+def find_messages(raw):
+    # Topic, start and size of the payload of every message
+    messages = []
+    position = 0
+
+    while position < len(raw):
+        space = raw[position:position + 256].tobytes().find(b' ')
+        if space < 0:
+            print("ERROR: No topic found at byte {:d}".format(position))
+            break
+
+        topic = raw[position:position + space].tobytes().decode('ascii', 'ignore')
+        payload_start = position + space + 1
+        payload_size = int(topic.rsplit('_s', 1)[1])
+
+        messages.append((topic, payload_start, payload_size))
+        position = payload_start + payload_size
+
+    return messages
+
+
+@jit(nopython=True)
+def grow_index(index, rows_filled):
+
+    # Double the capacity, amortized O(1) per appended waveform
+    new_index = np.empty(2 * index.shape[0], dtype=index.dtype)
+    new_index[:rows_filled] = index[:rows_filled]
+    return new_index
+
+
+@jit(nopython=True)
+def index_payload(raw, payload_start, payload_size, index, rows_filled):
+
+    position = payload_start
+    payload_stop = payload_start + payload_size
+
+    while position + WAVEFORM_HEADER_SIZE <= payload_stop:
+        # Little endian header
+        timestamp = np.uint64(0)
+        for i_byte in range(8):
+            timestamp |= np.uint64(raw[position + i_byte]) << np.uint64(8 * i_byte)
+        channel = raw[position + 8]
+        samples_number = np.uint32(0)
+        for i_byte in range(4):
+            samples_number |= np.uint32(raw[position + 9 + i_byte]) << np.uint32(8 * i_byte)
+        additional_waveforms = raw[position + 13]
+
+        if rows_filled == index.shape[0]:
+            index = grow_index(index, rows_filled)
+
+        new_row = index[rows_filled]
+        new_row.offset = position + WAVEFORM_HEADER_SIZE
+        new_row.timestamp = timestamp
+        new_row.channel = channel
+        new_row.samples_number = samples_number
+        rows_filled += 1
+
+        position += WAVEFORM_HEADER_SIZE + 2 * samples_number + samples_number * additional_waveforms
+
+    return index, rows_filled
+
+
+def index_waveforms(raw):
+    # Where every waveform in the file starts, nothing else is read
+    index = np.empty(1024, dtype=waveform_index_dtype)
+    rows_filled = 0
+
+    for topic, payload_start, payload_size in find_messages(raw):
+        if topic.startswith(WAVEFORMS_TOPIC):
+            index, rows_filled = index_payload(raw, payload_start, payload_size, index, rows_filled)
+
+    return index[:rows_filled]
+
+
+def read_samples(raw, offsets, samples_number):
+    # Samples of waveforms with the same length, as a 2D array
+    byte_indexes = offsets[:, np.newaxis] + 2 * np.arange(samples_number)
+    low_bytes = raw[byte_indexes].astype(np.uint16)
+    high_bytes = raw[byte_indexes + 1].astype(np.uint16)
+    return low_bytes | (high_bytes << 8)
+
+
+def channel_batches(raw, index, channel):
+    # Batches of samples from one channel, grouped by waveform length
+    channel_index = index[index['channel'] == channel]
+
+    for samples_number in np.unique(channel_index['samples_number']):
+        offsets = channel_index['offset'][channel_index['samples_number'] == samples_number]
+
+        for batch_start in range(0, len(offsets), BATCH_SIZE):
+            yield read_samples(raw, offsets[batch_start:batch_start + BATCH_SIZE], int(samples_number))
+
+# =============================================================================
+# Calculation
+# =============================================================================
+
+def polarity_sign(user_config):
+    if "positive" in user_config.get("pulse_polarity", "negative").lower():
+        return 1.0
+    return -1.0
+
+
+def find_trigger_positions(samples, user_config):
+    # CFD on the smoothed waveform, the trigger is the zero crossing
+    baseline_samples = max(int(user_config["baseline_samples"]), 1)
+    smooth_samples = max(int(user_config["smooth_samples"]), 1)
+    delay = int(user_config["delay"])
+    fraction = float(user_config["fraction"])
+
+    samples = samples.astype(np.float64)
+    samples -= samples[:, :baseline_samples].mean(axis=1)[:, np.newaxis]
+
+    # Pulses are made positive
+    samples *= polarity_sign(user_config)
+
+    # Running mean
+    cumulative = np.cumsum(samples, axis=1)
+    smoothed = cumulative.copy()
+    smoothed[:, smooth_samples:] -= cumulative[:, :-smooth_samples]
+    smoothed /= smooth_samples
+
+    # Attenuated signal minus the delayed signal, positive then negative
+    CFD = fraction * smoothed
+    CFD[:, delay:] -= smoothed[:, :-delay] if delay > 0 else smoothed
+
+    # Last crossing from positive to negative before the minimum
+    index_min = np.argmin(CFD, axis=1)
+    columns = np.arange(CFD.shape[1] - 1)
+    crossings = (CFD[:, :-1] >= 0) & (CFD[:, 1:] < 0) & (columns < index_min[:, np.newaxis])
+
+    last_crossing = CFD.shape[1] - 2 - np.argmax(crossings[:, ::-1], axis=1)
+    return np.where(crossings.any(axis=1), last_crossing, 0).astype(np.int64)
+
+
+def region_columns(regions):
+    # Columns of the aligned curve integral that the given regions use
+    regions = np.asarray(regions, dtype=np.int64).reshape(-1, 4)
+    return np.unique(regions + np.array([0, 1, 0, 1]))
+
+
+def curve_integrals(samples, trigger_positions, user_config, columns):
+    """
+    Baseline subtracted cumulative integral of every waveform, as in
+    libPSD_Elias.c energy_analysis(). Column j is the curve_integral at
+    local_trigger_position - pregate + j - 2, so that a region is
+    curve[:, stop + 1] - curve[:, start]. Only the given columns are kept.
+    Also returns the scaled qlong, with the same clamping of the gates.
+    """
+    waveforms_number, samples_number = samples.shape
+    rows = np.arange(waveforms_number)
+    baseline_samples = int(user_config["baseline_samples"])
+    pregate = int(user_config["pregate"])
+    long_gate = int(user_config["long_gate"])
+
+    local_start = np.clip(trigger_positions - pregate - baseline_samples, 0, samples_number - 1)
+    local_trigger_position = np.clip(trigger_positions - local_start, 0, samples_number - 1)
+    local_end = samples_number - local_start
+
+    baseline_end = np.clip(baseline_samples, 1, local_end)
+
+    # Every waveform from its local_start, the rest is padded with zeros
+    local_columns = local_start[:, np.newaxis] + np.arange(samples_number)
+    inside = local_columns < samples_number
+    local_samples = np.where(inside, samples[rows[:, np.newaxis], np.minimum(local_columns, samples_number - 1)], 0)
+
+    samples_cumulative = np.cumsum(local_samples.astype(np.uint64), axis=1)
+    raw_baseline = samples_cumulative[rows, baseline_end - 1]
+    baseline = raw_baseline.astype(np.float64) / baseline_end
+
+    curve_integral = samples_cumulative - baseline[:, np.newaxis] * (np.arange(samples_number) + 1)
+    curve_integral[~inside] = np.nan
+
+    # The long gate, clamped as in the C code
+    long_gate_start = np.clip(local_trigger_position - pregate, 0, local_end - 1)
+    long_gate_end = np.clip(long_gate_start + long_gate - 1, 0, local_end - 1)
+    qlong = curve_integral[rows, long_gate_end] - curve_integral[rows, np.maximum(long_gate_start - 2, 0)]
+
+    scaled_qlong = qlong * float(user_config.get("integrals_scaling", 1)) * polarity_sign(user_config)
+
+    # Regions are relative to local_trigger_position - pregate, without clamping
+    aligned_columns = (local_trigger_position - pregate - 2)[:, np.newaxis] + columns
+    valid = (aligned_columns >= 0) & (aligned_columns < samples_number)
+    aligned = np.where(valid, curve_integral[rows[:, np.newaxis], np.clip(aligned_columns, 0, samples_number - 1)], np.nan)
+
+    return aligned, scaled_qlong
+
+
+# =============================================================================
+# Histograms
+# =============================================================================
+
+def histogram_bins(spec_channel):
+    # Bin positions as given by parse_data_spec()
+    energies = np.linspace(spec_channel["min_E"], spec_channel["max_E"], spec_channel["bins_E"])
+    PSDs = np.linspace(spec_channel["min_PSD"], spec_channel["max_PSD"], spec_channel["bins_PSD"])
+    return energies, PSDs
+
+
+@jit(nopython=True, cache=True)
+def fill_histograms(aligned, scaled_qlong, positions,
+                    energy_threshold, PSD_min, PSD_max,
+                    E_min, E_max, PSD_hist_min, PSD_hist_max,
+                    energy_counts, counts2d):
+    """
+    Adds the events of every region to its spec histograms. Each region is
+    four columns of aligned, so all of them are done per waveform.
+    """
+    E_N = energy_counts.shape[1]
+    PSD_N = counts2d.shape[1]
+
+    for i_waveform in range(aligned.shape[0]):
+        # Same for every region
+        if not scaled_qlong[i_waveform] >= energy_threshold:
+            continue
+
+        # Rounded as in C, saturated to the uint16 qlong
+        rounded_qlong = np.floor(abs(scaled_qlong[i_waveform]) + 0.5)
+        if scaled_qlong[i_waveform] < 0 or rounded_qlong > 65535:
+            qlong = 65535
+        else:
+            qlong = int(rounded_qlong)
+
+        if qlong < E_min or qlong >= E_max:
+            continue
+        E_bin = int((qlong - E_min) / (E_max - E_min) * E_N)
+
+        for i_region in range(positions.shape[0]):
+            qreg1 = aligned[i_waveform, positions[i_region, 1]] - aligned[i_waveform, positions[i_region, 0]]
+            qreg2 = aligned[i_waveform, positions[i_region, 3]] - aligned[i_waveform, positions[i_region, 2]]
+
+            if qreg2 != 0:
+                PSD_Elias = qreg1 / qreg2
+            else:
+                PSD_Elias = PSD_min - 1
+
+            # Also discards regions outside of the waveform
+            if not (PSD_Elias >= PSD_min and PSD_Elias <= PSD_max):
+                continue
+
+            energy_counts[i_region, E_bin] += 1
+
+            # The baseline field is a uint16, the PSD is stored times 1000
+            baseline = int(PSD_Elias * 1000) & 0xFFFF
+
+            if baseline < PSD_hist_min or baseline >= PSD_hist_max:
+                continue
+            PSD_bin = int((baseline - PSD_hist_min) / (PSD_hist_max - PSD_hist_min) * PSD_N)
+            counts2d[i_region, PSD_bin, E_bin] += 1
+
+
+def evaluate_grid(raw_file, channel, user_config, spec_channel, regions):
+    """
+    Spec histograms of every region, with as few passes over the waveforms
+    as the histograms fit in MAX_HISTOGRAM_BYTES, usually only one.
+    Yields the regions of every pass with their energy_counts and counts2d.
+    """
+    raw = map_raw_file(raw_file)
+    index = index_waveforms(raw)
+
+    regions = np.asarray(regions, dtype=np.int64).reshape(-1, 4)
+
+    E_N = spec_channel["bins_E"]
+    PSD_N = spec_channel["bins_PSD"]
+    region_bytes = (E_N + PSD_N * E_N) * np.dtype(np.uint32).itemsize
+    regions_per_pass = max(MAX_HISTOGRAM_BYTES // region_bytes, 1)
+
+    for pass_start in range(0, len(regions), regions_per_pass):
+        pass_regions = regions[pass_start:pass_start + regions_per_pass]
+
+        columns = region_columns(pass_regions)
+        # Region edges as positions in the kept columns
+        positions = np.searchsorted(columns, pass_regions + np.array([0, 1, 0, 1]))
+
+        energy_counts = np.zeros((len(pass_regions), E_N), dtype=np.uint32)
+        counts2d = np.zeros((len(pass_regions), PSD_N, E_N), dtype=np.uint32)
+
+        for samples in channel_batches(raw, index, channel):
+            trigger_positions = find_trigger_positions(samples, user_config)
+            aligned, scaled_qlong = curve_integrals(samples, trigger_positions, user_config, columns)
+
+            fill_histograms(aligned, scaled_qlong, positions,
+                            float(user_config.get("energy_threshold", 0)),
+                            float(user_config.get("PSD_min", -0.1)),
+                            float(user_config.get("PSD_max", 1.1)),
+                            spec_channel["min_E"], spec_channel["max_E"],
+                            spec_channel["min_PSD"], spec_channel["max_PSD"],
+                            energy_counts, counts2d)
+
+        yield pass_regions, energy_counts, counts2d
+
+# =============================================================================
+# Comparison
+# =============================================================================
+
+# Differing bins that are listed for every histogram
+LISTED_BINS = 10
+
+
+def compare_spectra(offline_spectra, online_spectra):
+    """
+    Bin by bin differences of the offline and online spectra of one point,
+    both as (energies, PSDs, energy_counts, counts2d). The offline
+    calculation is the same as waan only if no bin differs.
+    """
+    offline_energies, offline_PSDs, offline_energy_counts, offline_counts2d = offline_spectra
+    online_energies, online_PSDs, online_energy_counts, online_counts2d = online_spectra
+
+    comparison = dict()
+    comparison["same_bins"] = bool(np.array_equal(offline_energies, online_energies)
+                                   and np.array_equal(offline_PSDs, online_PSDs))
+    if not comparison["same_bins"]:
+        comparison["identical"] = False
+        return comparison
+
+    for name, offline_counts, online_counts in (("energy_counts", offline_energy_counts, online_energy_counts),
+                                                ("counts2d", offline_counts2d, online_counts2d)):
+        difference = np.asarray(offline_counts, dtype=np.int64) - np.asarray(online_counts, dtype=np.int64)
+        differing = np.flatnonzero(difference)
+
+        comparison[name] = {"offline_counts": int(np.sum(offline_counts, dtype=np.int64)),
+                            "online_counts": int(np.sum(online_counts, dtype=np.int64)),
+                            "differing_bins": len(differing),
+                            "largest_difference": int(np.abs(difference).max()) if len(differing) > 0 else 0,
+                            # Bin, offline counts and online counts
+                            "bins": [[[int(i) for i in np.unravel_index(i_bin, difference.shape)],
+                                      int(np.ravel(offline_counts)[i_bin]), int(np.ravel(online_counts)[i_bin])]
+                                     for i_bin in differing[:LISTED_BINS]],
+                            }
+
+    comparison["identical"] = comparison["energy_counts"]["differing_bins"] == 0 and comparison["counts2d"]["differing_bins"] == 0
+
+    return comparison
@@ -0,0 +1,261 @@
+"""
+Spring 2024
+Elias Arnqvist
+
+Binary store for the spectra of every point of an optimizer scan, instead of
+two csv files per point. A store is a folder with:
+    axes.npz            energies and PSDs, the same for all points
+    energy_counts.u32   one energy spectrum per point, uint32
+    counts2d.u32        one PSD vs energy spectrum per point, uint32
+    index.csv           reg1, reg2, dist1, dist2 and record number per point
+
+Points are appended, the spectra first and then the line in the index, so a
+point is only in the store when all of it is written. Spectra after the last
+line of the index, from a run that stopped while writing, are cut away when
+the store is opened again.
+
+Every run is kept in a subfolder named after a key of what the spectra
+depend on besides the parameters (raw file, channel config...), see
+open_run(). Points that are already in the store of a run with the same key
+do not have to be evaluated again, so a scan can be resumed after a crash and
+overlapping scans share points.
+
+load_scan() memory maps all spectra and gives a 4D array of record numbers
+over reg1, reg2, dist1 and dist2, so that the spectra of the whole scan can
+be used without reading them all. Points that were not evaluated are False
+in scan["present"], their record number is not a valid index:
+    scan = result_store.load_scan("PSD_spectra/<key>/")
+    point = (i_reg1, i_reg2, i_dist1, i_dist2)
+    if scan["present"][point]:
+        counts2d = scan["counts2d"][scan["record"][point]]
+"""
+
+import os
+import csv
+import json
+import hashlib
+
+import numpy as np
+
+AXES_FILE = "axes.npz"
+ENERGY_COUNTS_FILE = "energy_counts.u32"
+COUNTS2D_FILE = "counts2d.u32"
+INDEX_FILE = "index.csv"
+
+PARAMETER_NAMES = ["reg1", "reg2", "dist1", "dist2"]
+
+COUNTS_DTYPE = np.dtype(np.uint32)
+
+KEY_FILE = "key.json"
+
+# Record number of points that are not in the store, too large to index any spectra
+MISSING_RECORD = np.iinfo(np.int64).max
+
+# Bytes hashed at the start and at the end of the raw file, hashing all of it takes too long
+FINGERPRINT_BYTES = 2**20
+
+# =============================================================================
+# Writing
+# =============================================================================
+
+def open_store(folder):
+    os.makedirs(folder, exist_ok=True)
+
+    store = dict()
+    store["folder"] = folder
+    store["index"] = load_index(folder)
+    store["records"] = len(read_index_lines(folder))
+    store["energies"] = None
+    store["PSDs"] = None
+
+    if os.path.exists(os.path.join(folder, AXES_FILE)):
+        with np.load(os.path.join(folder, AXES_FILE)) as axes:
+            store["energies"] = axes["energies"]
+            store["PSDs"] = axes["PSDs"]
+
+        # Spectra that did not make it to the index
+        E_N, PSD_N = len(store["energies"]), len(store["PSDs"])
+        truncate(os.path.join(folder, ENERGY_COUNTS_FILE), store["records"] * E_N * COUNTS_DTYPE.itemsize)
+        truncate(os.path.join(folder, COUNTS2D_FILE), store["records"] * PSD_N * E_N * COUNTS_DTYPE.itemsize)
+
+    return store
+
+
+def truncate(file_name, size):
+    if os.path.exists(file_name) and os.path.getsize(file_name) > size:
+        with open(file_name, 'r+b') as file:
+            file.truncate(size)
+
+
+def append(store, parameters, energies, PSDs, energy_counts, counts2d):
+    folder = store["folder"]
+
+    if store["energies"] is None:
+        np.savez(os.path.join(folder, AXES_FILE), energies=energies, PSDs=PSDs)
+        store["energies"] = np.asarray(energies)
+        store["PSDs"] = np.asarray(PSDs)
+        write_index_header(folder)
+    elif len(energies) != len(store["energies"]) or len(PSDs) != len(store["PSDs"]):
+        raise ValueError("Spectra of {} do not have the size of the spectra in {}".format(parameters, folder))
+
+    for file_name, counts in ((ENERGY_COUNTS_FILE, energy_counts), (COUNTS2D_FILE, counts2d)):
+        with open(os.path.join(folder, file_name), 'ab') as file:
+            file.write(np.ascontiguousarray(counts, dtype=COUNTS_DTYPE).tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+    parameters = tuple(int(parameter) for parameter in parameters)
+
+    with open(os.path.join(folder, INDEX_FILE), 'a', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(list(parameters) + [store["records"]])
+
+    store["index"][parameters] = store["records"]
+    store["records"] += 1
+
+
+def write_index_header(folder):
+    with open(os.path.join(folder, INDEX_FILE), 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(PARAMETER_NAMES + ["record"])
+
+# =============================================================================
+# Runs
+# =============================================================================
+
+def file_fingerprint(file_name):
+    size = os.path.getsize(file_name)
+
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        sha1.update(file.read(FINGERPRINT_BYTES))
+        file.seek(max(size - FINGERPRINT_BYTES, 0))
+        sha1.update(file.read(FINGERPRINT_BYTES))
+
+    return {"name": os.path.basename(file_name), "size": size, "sha1": sha1.hexdigest()}
+
+
+def run_key(description):
+    text = json.dumps(description, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def describe_run(raw_file, config, spec_config, channels_index, channel, offline):
+    """
+    What the spectra depend on besides the parameters: the raw file, the
+    channel config without the regions, the mode and the spec bins. config
+    and spec_config are the loaded waan and spec configs.
+    """
+    channel_config = config['channels'][channels_index]
+    user_config = {key: value for key, value in channel_config['user_config'].items() if not key.startswith("reg")}
+
+    description = dict()
+    description["raw_file"] = file_fingerprint(raw_file)
+    description["channel"] = channel
+    description["channel_config"] = dict(channel_config, user_config=user_config)
+    description["offline"] = offline
+    # The bins of the histograms, offline and in spec, which is started with the same config
+    description["spec_channel"] = [spec_channel for spec_channel in spec_config["channels"] if spec_channel["id"] == channel][0]
+
+    return description
+
+
+def run_folder(folder, description):
+    return os.path.join(folder, run_key(description))
+
+
+def open_run(folder, description):
+    """
+    Store of the run in folder with the given description, that has to be
+    JSON serializable. The description is saved in key.json.
+    """
+    store = open_store(run_folder(folder, description))
+
+    with open(os.path.join(store["folder"], KEY_FILE), 'w') as file:
+        json.dump(description, file, indent=4, sort_keys=True)
+
+    return store
+
+
+def read_spectra(store, parameters):
+    # Spectra of a point that is in the store
+    record = store["index"][tuple(int(parameter) for parameter in parameters)]
+    E_N, PSD_N = len(store["energies"]), len(store["PSDs"])
+
+    energy_counts = np.fromfile(os.path.join(store["folder"], ENERGY_COUNTS_FILE), dtype=COUNTS_DTYPE,
+                                count=E_N, offset=record * E_N * COUNTS_DTYPE.itemsize)
+    counts2d = np.fromfile(os.path.join(store["folder"], COUNTS2D_FILE), dtype=COUNTS_DTYPE,
+                           count=PSD_N * E_N, offset=record * PSD_N * E_N * COUNTS_DTYPE.itemsize)
+
+    return store["energies"], store["PSDs"], energy_counts, counts2d.reshape(PSD_N, E_N)
+
+# =============================================================================
+# Loading
+# =============================================================================
+
+def read_index_lines(folder):
+    file_name = os.path.join(folder, INDEX_FILE)
+    if not os.path.exists(file_name):
+        return []
+
+    with open(file_name, newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        return [[int(value) for value in row] for row in reader if len(row) == len(PARAMETER_NAMES) + 1]
+
+
+def load_index(folder):
+    # Parameters to record number, the last record if a point was done again
+    return {tuple(row[:-1]): row[-1] for row in read_index_lines(folder)}
+
+
+def load_records(folder):
+    """
+    Energies, PSDs and memory mapped spectra of all records, with shapes
+    (records, E_N) and (records, PSD_N, E_N).
+    """
+    records = len(read_index_lines(folder))
+
+    with np.load(os.path.join(folder, AXES_FILE)) as axes:
+        energies = axes["energies"]
+        PSDs = axes["PSDs"]
+
+    E_N, PSD_N = len(energies), len(PSDs)
+
+    energy_counts = np.memmap(os.path.join(folder, ENERGY_COUNTS_FILE), dtype=COUNTS_DTYPE, mode='r',
+                              shape=(records, E_N))
+    counts2d = np.memmap(os.path.join(folder, COUNTS2D_FILE), dtype=COUNTS_DTYPE, mode='r',
+                         shape=(records, PSD_N, E_N))
+
+    return energies, PSDs, energy_counts, counts2d
+
+
+def load_scan(folder):
+    """
+    The values of reg1, reg2, dist1 and dist2 that are in the store, the 4D
+    array of record numbers over them, the 4D array present that is False
+    where a point is missing, and the memory mapped spectra from
+    load_records(). The record number of a missing point is MISSING_RECORD,
+    which is out of range of the spectra, so using it raises an IndexError.
+    """
+    index = load_index(folder)
+    energies, PSDs, energy_counts, counts2d = load_records(folder)
+
+    scan = dict()
+    points = np.array(sorted(index), dtype=np.int64).reshape(-1, len(PARAMETER_NAMES))
+
+    for i, name in enumerate(PARAMETER_NAMES):
+        scan[name] = np.unique(points[:, i])
+
+    scan["record"] = np.full([len(scan[name]) for name in PARAMETER_NAMES], MISSING_RECORD, dtype=np.int64)
+    for parameters, record in index.items():
+        position = tuple(np.searchsorted(scan[name], value) for name, value in zip(PARAMETER_NAMES, parameters))
+        scan["record"][position] = record
+    scan["present"] = scan["record"] != MISSING_RECORD
+
+    scan["energies"] = energies
+    scan["PSDs"] = PSDs
+    scan["energy_counts"] = energy_counts
+    scan["counts2d"] = counts2d
+
+    return scan
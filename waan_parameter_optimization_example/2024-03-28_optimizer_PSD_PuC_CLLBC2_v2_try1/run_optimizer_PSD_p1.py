@@ -9,26 +9,60 @@ It will go through a range of parameters specified below.
 To function, tmux needs to be running with ABCD. 
 This is done with a startup script. 
 Then this script can be executed. 
+
+To scan with several ABCD pipelines at the same time, set INSTANCES and
+start that many instances with the startup script first:
+    for i in 0 1 2 3; do ./startup_optimization_PSD.sh $i; done
+Grid points are then given to whichever instance is free.
+
+With OFFLINE = True, ABCD is not needed. offline_PSD.py calculates the
+spectra of many points of the 4D grid, also along dist1 and dist2, in one
+pass over the raw file.
+
+The ABCD modules are talked to through abcd_client.py, with asyncio.
+
+The spectra are saved with result_store.py, in a subfolder of RESULTS_FOLDER
+for the raw file, channel config and mode. Points that are already there are
+not evaluated again, so a stopped scan is resumed by starting it again.
+
+Every point gets a neutron/gamma figure of merit from its PSD spectrum.
+With SEARCH = "adaptive" only a coarse grid is tried first, and then the
+neighbourhood of the best points with finer and finer steps.
 """
 
 import numpy as np
 import scipy.optimize as opt
 
+import os
 import datetime
-import zmq
+import zmq.asyncio
 import json
-import time
-import threading
+import itertools
+import asyncio
 
 import subprocess
 import csv
 
+import offline_PSD
+import abcd_client
+import result_store
+
 # Addresses for ABCD
 ADDRESS_COMMANDS_WAAN = 'tcp://127.0.0.1:16208'
+ADDRESS_STATUS_WAAN = 'tcp://127.0.0.1:16206'
 ADDRESS_COMMANDS_SPEC = 'tcp://127.0.0.1:16189'
 ADDRESS_COMMANDS_TOFCALC = 'tcp://127.0.0.1:16202'
 ADDRESS_DATA_SPEC = 'tcp://127.0.0.1:16188'
 ADDRESS_DATA_TOFCALC = 'tcp://127.0.0.1:16201'
+ADDRESS_REPLAY_DATA = 'tcp://*:16207'
+
+# Number of ABCD pipelines to run grid points on at the same time
+INSTANCES = 1
+# Ports of instance i are moved up by i * PORT_STRIDE, same as in the startup script
+PORT_STRIDE = 100
+
+# Calculate the PSD in this script instead of replaying through ABCD
+OFFLINE = False
 
 # =============================================================================
 # Specify paths
@@ -38,13 +72,13 @@ ADDRESS_DATA_TOFCALC = 'tcp://127.0.0.1:16201'
 RAW_FILE = "/home/elias/abcd_data/2024-03-14_run1_PuC_20min_8detectors_CLLBC123/2024-03-14T11-48-49_DT5730_PuC_Ch0_CLLBC1_HV-810_Ch1_CLLBC2_HV-760_Ch2_TheBeast_HV700_Ch3_LaBr19.2_HV626_Ch4_LaBr19.4_HV539_Ch5_LaBr19.6_HV539_Ch6_LaBr19.8_HV620_Ch7_CLLBC3_HV790_raw.adr"
 # Config file for this script to change the parameters in
 CONFIG_FILE = "config_Elias.json"
-# Log file that is used by this script to keep track of what is done
-# LOG_FILE = "optimization_log_file_1.csv"
 # Location of ABCD's replay script
 # REPLAY_RAW = "/home/localusr/abcd/replay/replay_raw.py"
 REPLAY_RAW = "/home/elias/abcd/replay/replay_raw.py"
-# Where to save csv files
-CSV_FOLDER = "PSD_spectra/"
+# Spec config, for the histograms when running offline
+SPEC_FILE = "spec_Elias.json"
+# Where to save the spectra of every point, see result_store.py, and FOM.csv
+RESULTS_FOLDER = "PSD_spectra/"
 
 # =============================================================================
 # Parameters to change
@@ -73,13 +107,42 @@ DIST2_MIN = 0
 DIST2_MAX = 1
 DIST2_STEP = 1
 
+# =============================================================================
+# Search
+# =============================================================================
+
+# "adaptive" refines around the best points, "brute" tries every grid point
+SEARCH = "adaptive"
+# The first grid uses every COARSE_FACTOR:th value of every parameter
+COARSE_FACTOR = 4
+# Number of best points that are refined in every round
+REFINE_POINTS = 3
+
+# Energy range of the PSD projection for the figure of merit
+FOM_ENERGY_MIN = 25000
+FOM_ENERGY_MAX = 60000
+# With fewer counts in the projection or in a peak the figure of merit is 0
+FOM_MIN_COUNTS = 100
+
 # =============================================================================
 # Values
 # =============================================================================
 
 s = 1
 REPLAY_TIME = 180*s
-RESET_TIME = 6*s
+# Longest wait for an answer from waan or spec
+WAIT_TIMEOUT = 30*s
+# waan confirms a reconfigure with an event, for a waan that does not, set
+# a delay after which the new config is assumed to be used, e.g. 6*s
+RECONFIGURE_DELAY = None
+# Longest wait for the spectra to settle after a replay, the point fails after that
+SETTLE_TIMEOUT = 120*s
+# Seconds between checks whether a replay can be stopped early, 0 to never stop
+EARLY_STOP_INTERVAL = 10*s
+# Stop when the FOM is this many standard deviations below the best so far
+EARLY_STOP_SIGMAS = 3
+# FOM of a stopped or failed point, it is never refined and never the best
+DOMINATED_FOM = -np.inf
 
 # Number of steps for the parameters
 REG1_STEPS = int((REG1_MAX - REG1_MIN) / REG1_STEP)
@@ -99,105 +162,125 @@ ENERGY_DELTA = 10
 ENERGY_THRESHOLD_GAMMA_MIN = 0
 ENERGY_THRESHOLD_GAMMA_MAX = 66000
 
-lock_spec = threading.Lock()
-last_reception_spec = dict()
-
-worker_calls = 0
-received_messages_spec = 0
-msg_ID = 0
-
-context = zmq.Context()
-
-socket_commands_waan = context.socket(zmq.PUSH)
-socket_commands_waan.connect(ADDRESS_COMMANDS_WAAN)
-socket_commands_spec = context.socket(zmq.PUSH)
-socket_commands_spec.connect(ADDRESS_COMMANDS_SPEC)
-socket_commands_tofcalc = context.socket(zmq.PUSH)
-socket_commands_tofcalc.connect(ADDRESS_COMMANDS_TOFCALC)
-socket_data_spec = context.socket(zmq.SUB)
-socket_data_spec.connect(ADDRESS_DATA_SPEC)
-socket_data_spec.setsockopt(zmq.SUBSCRIBE, "data_spec_histograms".encode("ascii"))
-socket_data_tofcalc = context.socket(zmq.SUB)
-socket_data_tofcalc.connect(ADDRESS_DATA_TOFCALC)
-socket_data_tofcalc.setsockopt(zmq.SUBSCRIBE, "data_tofcalc_histograms".encode("ascii"))
+# Commands and subscribed addresses of the ABCD modules, tofcalc is not used
+ADDRESSES = {"waan": (ADDRESS_COMMANDS_WAAN, ADDRESS_STATUS_WAAN),
+             "spec": (ADDRESS_COMMANDS_SPEC, ADDRESS_DATA_SPEC),
+             }
 
 # =============================================================================
 # Functions
 # =============================================================================
 
-# Gets data from ABCD
-def receiver(lock, last_reception, socket_data, received_messages):
-    try:
-        while 1:
-            topic, json_message = socket_data.recv().decode('ascii', 'ignore').split(' ', 1)
-
-            received_messages += 1
-            now = datetime.datetime.now()
-
-            print("Message received at: {} with topic: {}".format(now, topic))
-
-            with lock:
-                last_reception["timestamp"] = now
-                last_reception["payload"] = json.loads(json_message)
-                last_reception["topic"] = topic
-    except Exception as error:
-        print("ERROR: {}".format(error))
-
-
 # Updates parameters
-def send_parameters(parameters):
-    global msg_ID
-    global socket_commands_waan
-    global socket_commands_spec
-
+async def send_parameters(pipeline, parameters):
     reg1, reg2, dist1, dist2 = parameters
 
     print("Sending parameters: reg1: {:f}".format(reg1))
     print("                    reg2: {:f}".format(reg2))
     print("                    dist1: {:f}".format(dist1))
     print("                    dist2: {:f}".format(dist2))
-    print("                    msg_ID: {:d}".format(msg_ID))
+    print("                    instance: {:d}".format(pipeline["instance"]))
 
     with open(CONFIG_FILE) as config_file:
         config = json.load(config_file)
     
-    reg1_start = dist1
-    reg1_stop = dist1 + reg1
-    reg2_start = dist1 + reg1 + dist2
-    reg2_stop = dist1 + reg1 + dist2 + reg2
+    reg1_start, reg1_stop, reg2_start, reg2_stop = regions_from_parameters(reg1, reg2, dist1, dist2)
     
     config['channels'][CHANNELS_INDEX]['user_config']['reg1_start'] = int(reg1_start)
     config['channels'][CHANNELS_INDEX]['user_config']['reg1_stop'] = int(reg1_stop)
     config['channels'][CHANNELS_INDEX]['user_config']['reg2_start'] = int(reg2_start)
     config['channels'][CHANNELS_INDEX]['user_config']['reg2_stop'] = int(reg2_stop)
 
-    message = dict()
-    message["msg_ID"] = msg_ID
-    msg_ID += 1
-    message["timestamp"] = datetime.datetime.now().isoformat()
-    message["command"] = "reconfigure"
-    message["arguments"] = {"config": config}
+    # The replay only starts when waan uses the new regions
+    print("Waiting for waan to apply the new config")
+    if await abcd_client.reconfigure(pipeline, config, WAIT_TIMEOUT, delay=RECONFIGURE_DELAY) is None:
+        print("WARNING: No reconfiguration event from waan, the point failed")
+        return False
+    
+    # The first empty spectrum after the reset, older spectra are not used after this
+    print("Sending reset to spec")
+    if await abcd_client.reset(pipeline, WAIT_TIMEOUT) is None:
+        print("WARNING: No empty spectra from spec after reset, the point failed")
+        return False
 
-    json_message = json.dumps(message)
+    return True
 
-    socket_commands_waan.send(json_message.encode('ascii'))
 
-    print("Waiting reset: {:f} s".format(RESET_TIME))
-    time.sleep(RESET_TIME)
-    
-    print("Sending reset to spec")
-    print("msg_ID: {:d}, received_messages_spec: {:d}".format(msg_ID, received_messages_spec))
+# Counts in the energy spectrum of the channel
+def spectrum_counts(payload):
+    for channel in payload["data"]:
+        if channel["id"] == CHANNEL:
+            return sum(channel["energy"]["data"])
+    return 0
+
+
+# The spectra are final when two in a row have the same counts, None if they do not settle
+async def final_spectra(pipeline):
+    # Spectra published during the replay are not final
+    abcd_client.latest_histogram(pipeline)
+    previous_counts = -1
 
-    message = dict()
-    message["msg_ID"] = msg_ID
-    msg_ID += 1
-    message["timestamp"] = datetime.datetime.now().isoformat()
-    message["command"] = "reset"
-    message["arguments"] = {"channel": "all"}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SETTLE_TIMEOUT
 
-    json_message = json.dumps(message).encode('ascii')
+    while True:
+        message = await abcd_client.next_histogram(pipeline, min(WAIT_TIMEOUT, deadline - loop.time()))
+        if message is None:
+            print("WARNING: Spectra from spec did not settle, the point failed")
+            return None
 
-    socket_commands_spec.send(json_message)
+        counts = spectrum_counts(abcd_client.payload(message))
+        if counts == previous_counts:
+            return abcd_client.payload(message)
+        previous_counts = counts
+
+
+# Runs the replay, and stops it when the spectra show that it is not worth finishing
+async def replay(pipeline, subproc):
+    process = await asyncio.create_subprocess_exec(*subproc, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    communicate = asyncio.ensure_future(process.communicate())
+    timeout = EARLY_STOP_INTERVAL if EARLY_STOP_INTERVAL > 0 else None
+
+    try:
+        while True:
+            done, pending = await asyncio.wait([communicate], timeout=timeout)
+            if done:
+                stopped_early = False
+                break
+            if is_dominated(pipeline):
+                process.terminate()
+                stopped_early = True
+                break
+
+        stdout, stderr = await communicate
+    except BaseException:
+        # Cancelled or failed, the replay is not left running
+        communicate.cancel()
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+        raise
+
+    return subprocess.CompletedProcess(subproc, process.returncode, stdout.decode(), stderr.decode()), stopped_early
+
+
+# True when the FOM so far is surely below the best FOM
+def is_dominated(pipeline):
+    # Only spectra from after the reset are left
+    message = abcd_client.latest_histogram(pipeline)
+    if message is None:
+        return False
+
+    spectra = parse_data_spec(abcd_client.payload(message))
+    if spectra is None:
+        return False
+
+    energies, PSDs, energy_counts, counts2d = spectra
+    FOM, FOM_error = figure_of_merit(energies, PSDs, counts2d)
+
+    print("FOM so far: {:f} +- {:f}, best: {:f}".format(FOM, FOM_error, online["best_FOM"]))
+
+    return FOM + EARLY_STOP_SIGMAS * FOM_error < online["best_FOM"]
 
 
 def parse_data_spec(message):
@@ -219,43 +302,134 @@ def parse_data_spec(message):
 
             PSDs = np.linspace(PSD_min, PSD_max, PSD_N)
 
-            energy_counts = np.array(E_histo["data"], dtype = np.uint)
-            counts2d = np.array(PSDvsE_histo["data"], dtype = np.uint)
-            counts2d.shape = (PSD_N, E_N)
+            # Straight from the flat lists, as in the offline histograms
+            energy_counts = np.array(E_histo["data"], dtype = np.uint32)
+            counts2d = np.array(PSDvsE_histo["data"], dtype = np.uint32).reshape(PSD_N, E_N)
 
             return energies, PSDs, energy_counts, counts2d
 
     return None
 
 
-def worker_function(parameters):
-    global lock_spec
-    global last_reception_spec
-    global worker_calls
+# Region start and stop, as sent to waan
+def regions_from_parameters(reg1, reg2, dist1, dist2):
+    reg1_start = dist1
+    reg1_stop = dist1 + reg1
+    reg2_start = dist1 + reg1 + dist2
+    reg2_stop = dist1 + reg1 + dist2 + reg2
+    return reg1_start, reg1_stop, reg2_start, reg2_stop
+
+
+# Config of the channel, for running offline
+def load_offline():
+    with open(CONFIG_FILE) as config_file:
+        config = json.load(config_file)
+    with open(SPEC_FILE) as spec_file:
+        spec_config = json.load(spec_file)
+
+    offline = dict()
+    offline["user_config"] = config['channels'][CHANNELS_INDEX]['user_config']
+    offline["spec_channel"] = [channel for channel in spec_config["channels"] if channel["id"] == CHANNEL][0]
+    offline["energies"], offline["PSDs"] = offline_PSD.histogram_bins(offline["spec_channel"])
+
+    return offline
+
+
+# Spectra of all points, in as few passes over the raw file as possible
+def evaluate_offline(points):
+    regions = [regions_from_parameters(*parameters) for parameters in points]
+
+    print("Reading raw file: {}".format(RAW_FILE))
+    FOMs = []
+    for pass_regions, energy_counts, counts2d in offline_PSD.evaluate_grid(RAW_FILE, CHANNEL, offline["user_config"], offline["spec_channel"], regions):
+        for i_region in range(len(pass_regions)):
+            parameters = points[len(FOMs)]
+            save_spectra(parameters, offline["energies"], offline["PSDs"], energy_counts[i_region], counts2d[i_region])
+            FOMs.append(figure_of_merit(offline["energies"], offline["PSDs"], counts2d[i_region])[0])
+
+    return FOMs
+
+
+# Connects to every ABCD pipeline, all of them start out free
+async def open_online():
+    online = dict()
+    online["context"] = zmq.asyncio.Context()
+    online["pipelines"] = [await abcd_client.open_pipeline(online["context"], ADDRESSES, instance, PORT_STRIDE)
+                           for instance in range(INSTANCES)]
+    online["free_pipelines"] = asyncio.Queue()
+    for pipeline in online["pipelines"]:
+        if await abcd_client.wait_subscribed(pipeline, WAIT_TIMEOUT) is None:
+            print("WARNING: No status from waan of instance {:d}".format(pipeline["instance"]))
+        online["free_pipelines"].put_nowait(pipeline)
+
+    online["worker_calls"] = 0
+    # Best figure of merit so far, shared by all instances
+    online["best_FOM"] = 0.0
+
+    return online
+
+
+async def close_online():
+    for pipeline in online["pipelines"]:
+        await abcd_client.close_pipeline(pipeline)
+    online["context"].term()
+
 
-    worker_calls += 1
+# All points through the ABCD pipelines, as many at a time as there are pipelines
+def evaluate_online(points):
+    async def evaluate_points():
+        return await asyncio.gather(*[worker_function(parameters) for parameters in points])
 
-    print("Worker: worker_calls: {:d}".format(worker_calls))
+    return loop.run_until_complete(evaluate_points())
+
+
+async def worker_function(parameters):
+    # Wait for a free pipeline, and give it back when done
+    pipeline = await online["free_pipelines"].get()
+
+    online["worker_calls"] += 1
+
+    print("Worker: worker_calls: {:d}".format(online["worker_calls"]))
     print("        parameters: {}".format(parameters))
 
-    Delta_reg1, Delta_reg2 = parameters
-    
-    reg1 = int(Delta_reg1)
-    dist1 = int(DIST1_MIN)
-    dist2 = int(DIST2_MIN)
-    reg2 = int(Delta_reg2)
+    reg1, reg2, dist1, dist2 = [int(parameter) for parameter in parameters]
+
+    try:
+        spectra, complete = await evaluate_parameters(pipeline, (reg1, reg2, dist1, dist2))
+    finally:
+        online["free_pipelines"].put_nowait(pipeline)
+
+    # Stopped or failed replays only have partial spectra, they are done again when the scan is resumed
+    if not complete:
+        return DOMINATED_FOM
+
+    energies, PSDs, energy_counts, counts2d = spectra
+    save_spectra((reg1, reg2, dist1, dist2), energies, PSDs, energy_counts, counts2d)
 
-    send_parameters((reg1, reg2, dist1, dist2))
+    FOM = figure_of_merit(energies, PSDs, counts2d)[0]
+    online["best_FOM"] = max(online["best_FOM"], FOM)
+
+    return FOM
+
+
+async def evaluate_parameters(pipeline, parameters):
+    print("Instance: {:d}".format(pipeline["instance"]))
+
+    if not await send_parameters(pipeline, parameters):
+        return None, False
     
     start_replay = datetime.datetime.now()
     
-    # launch replay_raw.py with subprocess.run
+    # launch replay_raw.py as a subprocess
     # subproc = ["python3", REPLAY_RAW, "-D", "tcp://*:16207", "-T", "1", RAW_FILE]
-    subproc = ["python3", REPLAY_RAW, "-D", "tcp://*:16207", "-T", "10", RAW_FILE]
+    address_replay = abcd_client.instance_address(ADDRESS_REPLAY_DATA, pipeline["instance"], PORT_STRIDE)
+    subproc = ["python3", REPLAY_RAW, "-D", address_replay, "-T", "10", RAW_FILE]
     print("Starting subprocess: {}".format(" ".join(subproc)))
-    result = subprocess.run(subproc, capture_output=True, text=True)
+    result, stopped_early = await replay(pipeline, subproc)
     # Check the return code
-    if result.returncode == 0:
+    if stopped_early:
+        print("Replay stopped early, the point is worse than the best so far")
+    elif result.returncode == 0:
         print("Command executed successfully!")
         # Print the output
         print(result.stdout)
@@ -271,14 +445,19 @@ def worker_function(parameters):
     now = datetime.datetime.now()
     print("Replay time: {:f} s".format((now - start_replay).total_seconds()))
 
-    print("Waiting messages: {:f} s".format(RESET_TIME))
-    time.sleep(RESET_TIME)
-    
-    with lock_spec:
-        message_spec = last_reception_spec["payload"]
-    
-    energies, PSDs, energy_counts, counts2d = parse_data_spec(message_spec)
+    print("Waiting for the last events to reach spec")
+    message_spec = await final_spectra(pipeline)
+    if message_spec is None:
+        return None, False
+
+    spectra = parse_data_spec(message_spec)
     
+    return spectra, spectra is not None and result.returncode == 0 and not stopped_early
+
+
+def save_spectra(parameters, energies, PSDs, energy_counts, counts2d):
+    reg1, reg2, dist1, dist2 = parameters
+
     # print(energies)
     # print(PSDs)
     # print(energy_counts)
@@ -286,65 +465,227 @@ def worker_function(parameters):
     
     print("Parameters for last analysis: {:d}, {:d}, {:d}, {:d}".format(reg1, reg2, dist1, dist2))
     
-    # Write PSD to csv file
-    parameters_list = [reg1, reg2, dist1, dist2]
-    
-    data = zip(energies, energy_counts)
-    spec_filename = 'E_' + str(parameters_list)
-    with open(CSV_FOLDER + spec_filename + '.csv', 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerows(data)
-    
-    stacked_data = np.column_stack((PSDs, counts2d))
-    spec_filename = 'PSD_' + str(parameters_list)
-    with open(CSV_FOLDER + spec_filename + '.csv', 'w', newline='') as file:
+    result_store.append(store, parameters, energies, PSDs, energy_counts, counts2d)
+
+
+# =============================================================================
+# Figure of merit
+# =============================================================================
+
+def gaussians(x, A1, mu1, sigma1, A2, mu2, sigma2):
+    return (A1 * np.exp(-(x - mu1)**2 / (2 * sigma1**2))
+            + A2 * np.exp(-(x - mu2)**2 / (2 * sigma2**2)))
+
+
+def figure_of_merit(energies, PSDs, counts2d):
+    """
+    Neutron/gamma separation of the PSD projection in the energy range:
+    FOM = (mu_2 - mu_1) / (FWHM_1 + FWHM_2)
+    Returns the FOM and its statistical uncertainty, which is infinite
+    when there is no separation to measure.
+    """
+    in_range = (energies >= FOM_ENERGY_MIN) & (energies <= FOM_ENERGY_MAX)
+    projection = counts2d[:, in_range].sum(axis=1).astype(np.float64)
+
+    if projection.sum() < FOM_MIN_COUNTS:
+        return 0.0, np.inf
+
+    # Split the two peaks where the variance between them is the largest
+    counts_below = np.cumsum(projection)[:-1]
+    moment_below = np.cumsum(projection * PSDs)[:-1]
+    counts_above = projection.sum() - counts_below
+    moment_above = np.sum(projection * PSDs) - moment_below
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance_between = counts_below * counts_above * (moment_below / counts_below - moment_above / counts_above)**2
+    split = np.argmax(np.nan_to_num(variance_between)) + 1
+
+    # Peaks can not be narrower than the bins
+    bin_width = PSDs[1] - PSDs[0]
+    lower = [0, PSDs[0], bin_width / 2] * 2
+    upper = [np.inf, PSDs[-1], PSDs[-1] - PSDs[0]] * 2
+
+    # Mean and standard deviation of each side as the first guess
+    initial = []
+    for side in (slice(None, split), slice(split, None)):
+        weights = projection[side]
+        if weights.sum() == 0:
+            return 0.0, np.inf
+        mu = np.average(PSDs[side], weights=weights)
+        sigma = np.sqrt(np.average((PSDs[side] - mu)**2, weights=weights))
+        initial += [weights.max(), mu, np.clip(sigma, bin_width / 2, PSDs[-1] - PSDs[0])]
+
+    try:
+        fit, _ = opt.curve_fit(gaussians, PSDs, projection, p0=initial, bounds=(lower, upper))
+    except (RuntimeError, ValueError):
+        print("WARNING: Fit of the PSD peaks failed, using the moments")
+        fit = initial
+
+    sigma_1 = abs(fit[2])
+    sigma_2 = abs(fit[5])
+    peak_counts_1 = fit[0] * sigma_1 * np.sqrt(2 * np.pi) / bin_width
+    peak_counts_2 = fit[3] * sigma_2 * np.sqrt(2 * np.pi) / bin_width
+
+    # A peak made of a few stray counts is no separation
+    if min(peak_counts_1, peak_counts_2) < FOM_MIN_COUNTS:
+        return 0.0, np.inf
+
+    distance = abs(fit[4] - fit[1])
+    FOM = distance / (2 * np.sqrt(2 * np.log(2)) * (sigma_1 + sigma_2))
+
+    # Statistical errors of the peak positions and widths
+    distance_variance = sigma_1**2 / peak_counts_1 + sigma_2**2 / peak_counts_2
+    widths_variance = sigma_1**2 / (2 * peak_counts_1) + sigma_2**2 / (2 * peak_counts_2)
+    FOM_error = FOM * np.sqrt(distance_variance / distance**2 + widths_variance / (sigma_1 + sigma_2)**2)
+
+    return FOM, FOM_error
+
+# =============================================================================
+# Search
+# =============================================================================
+
+def parameter_values():
+    return [np.arange(REG1_MIN, REG1_MAX, REG1_STEP),
+            np.arange(REG2_MIN, REG2_MAX, REG2_STEP),
+            np.arange(DIST1_MIN, DIST1_MAX, DIST1_STEP),
+            np.arange(DIST2_MIN, DIST2_MAX, DIST2_STEP)]
+
+
+def search(evaluate_points):
+    """
+    Tries the coarse grid first, then the neighbours of the REFINE_POINTS
+    best points with half the step, until the step is one grid step.
+    With SEARCH = "brute" the first grid is the whole grid.
+    Returns the figure of merit of every tried point.
+    """
+    values = parameter_values()
+    sizes = [len(value) for value in values]
+
+    step = COARSE_FACTOR if SEARCH == "adaptive" else 1
+    # The last value is always included, the grid may not be a whole number of steps
+    indexes = [sorted(set(range(0, size, step)) | {size - 1}) for size in sizes]
+    candidates = set(itertools.product(*indexes))
+
+    results = dict()
+    while True:
+        new_candidates = sorted(candidates - set(results))
+        points = [tuple(int(value[i]) for value, i in zip(values, candidate)) for candidate in new_candidates]
+
+        print("Search step: {:d}, new points: {:d}".format(step, len(points)))
+
+        for candidate, FOM in zip(new_candidates, evaluate_points(points)):
+            results[candidate] = FOM
+
+        if step == 1:
+            break
+        step = max(step // 2, 1)
+
+        candidates = set()
+        for candidate in sorted(results, key=results.get, reverse=True)[:REFINE_POINTS]:
+            for shift in itertools.product((-step, 0, step), repeat=len(sizes)):
+                candidates.add(tuple(min(max(i + di, 0), size - 1) for i, di, size in zip(candidate, shift, sizes)))
+
+    return {tuple(int(value[i]) for value, i in zip(values, candidate)): FOM for candidate, FOM in results.items()}
+
+
+# Points that are in the store already are not evaluated again
+def evaluate_cached(evaluate_points):
+    def evaluate(points):
+        FOMs = dict()
+        for parameters in points:
+            if parameters in store["index"]:
+                energies, PSDs, energy_counts, counts2d = result_store.read_spectra(store, parameters)
+                FOMs[parameters] = figure_of_merit(energies, PSDs, counts2d)[0]
+
+        new_points = [parameters for parameters in points if parameters not in FOMs]
+        print("Points in the store: {:d}, to evaluate: {:d}".format(len(FOMs), len(new_points)))
+
+        if not OFFLINE and FOMs:
+            online["best_FOM"] = max(online["best_FOM"], max(FOMs.values()))
+
+        if new_points:
+            FOMs.update(zip(new_points, evaluate_points(new_points)))
+
+        return [FOMs[parameters] for parameters in points]
+
+    return evaluate
+
+
+# What the spectra depend on besides the parameters
+def run_description():
+    with open(CONFIG_FILE) as config_file:
+        config = json.load(config_file)
+    with open(SPEC_FILE) as spec_file:
+        spec_config = json.load(spec_file)
+
+    return result_store.describe_run(RAW_FILE, config, spec_config, CHANNELS_INDEX, CHANNEL, OFFLINE)
+
+
+def save_results(results):
+    with open(os.path.join(store["folder"], 'FOM.csv'), 'w', newline='') as file:
         writer = csv.writer(file)
-        # writer.writerows(PSDs.tolist())
-        # writer.writerows(energy_counts.tolist())
-        writer.writerows(stacked_data)
-    return 1
+        writer.writerow(["reg1", "reg2", "dist1", "dist2", "FOM"])
+        for parameters in sorted(results):
+            if results[parameters] == DOMINATED_FOM:
+                continue
+            writer.writerow(list(parameters) + [results[parameters]])
 
 
 # =============================================================================
 # Main
 # =============================================================================
 
-# Initialize threads for recieving spec and tof data from ABCD
-receiver_spec_thread = threading.Thread(target=receiver,
-                                        args=(lock_spec,
-                                              last_reception_spec,
-                                              socket_data_spec,
-                                              received_messages_spec))
-receiver_spec_thread.start()
-
 print("Steps: reg1: {:d}".format(REG1_STEPS))
 print("       reg2: {:d}".format(REG2_STEPS))
 print("       dist1: {:d}".format(DIST1_STEPS))
 print("       dist2: {:d}".format(DIST2_STEPS))
 
-total_steps = REG1_STEPS * REG2_STEPS * DIST1_STEPS * DIST2_STEPS
+total_steps = int(np.prod([len(values) for values in parameter_values()]))
 
 print("Total steps: {:d}".format(total_steps))
 
-total_time = (REPLAY_TIME + RESET_TIME) * total_steps
-
-print("Expected total time: {:f} hr".format(total_time / (3600*s)))
-print("Expected finish: {}".format(datetime.datetime.now() + datetime.timedelta(seconds = total_time)))
+store = result_store.open_run(RESULTS_FOLDER, run_description())
 
-rranges = (slice(REG1_MIN, REG1_MAX, REG1_STEP), slice(REG2_MIN, REG2_MAX, REG2_STEP))
+print("Results folder: {}".format(store["folder"]))
+print("Points in the store: {:d}".format(len(store["index"])))
 
-# resbrute = opt.brute(worker_function, rranges, full_output=True)
-resbrute = opt.brute(worker_function, rranges, full_output=True, finish=None)
+if OFFLINE:
+    offline = load_offline()
+    results = search(evaluate_cached(evaluate_offline))
+else:
+    # One event loop for all pipelines, the points are awaited at the same time
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
-print(resbrute)
+    online = loop.run_until_complete(open_online())
 
-print("Global minimum: {}".format(resbrute[0]))
-print("Function value: {}".format(resbrute[1]))
+    total_time = REPLAY_TIME * total_steps / INSTANCES
 
-socket_commands_waan.close()
-socket_commands_spec.close()
-socket_data_spec.close()
+    print("Expected total time, at most: {:f} hr".format(total_time / (3600*s)))
+    print("Expected finish, at latest: {}".format(datetime.datetime.now() + datetime.timedelta(seconds = total_time)))
 
-receiver_spec_thread.join()
-
-context.destroy()
+    try:
+        results = search(evaluate_cached(evaluate_online))
+    finally:
+        # Workers still running after an error or Ctrl-C are cancelled, which stops their replays
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+        loop.run_until_complete(close_online())
+        loop.close()
+
+save_results(results)
+
+# Stopped and failed points have no FOM
+evaluated = {parameters: FOM for parameters, FOM in results.items() if FOM != DOMINATED_FOM}
+
+print("Points tried: {:d} of {:d}".format(len(results), total_steps))
+print("Points stopped or failed: {:d}".format(len(results) - len(evaluated)))
+
+if evaluated:
+    best_parameters = max(evaluated, key=evaluated.get)
+    print("Best parameters: {}".format(best_parameters))
+    print("Figure of merit: {}".format(evaluated[best_parameters]))
+else:
+    print("WARNING: No point was evaluated completely")
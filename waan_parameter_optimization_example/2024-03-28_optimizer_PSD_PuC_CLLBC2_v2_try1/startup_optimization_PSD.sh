@@ -1,6 +1,14 @@
 #! /bin/bash
 #
 # Example of startup script
+#
+# Usage: ./startup_optimization_PSD.sh [instance]
+#
+# Without an instance the full ABCD session is started, as usual.
+# With an instance number, only WaAn and spec are started, in their own tmux
+# session and on their own ports, moved up by instance * PORT_STRIDE.
+# Several instances can then run at the same time for a parallel parameter scan:
+#     for i in 0 1 2 3; do ./startup_optimization_PSD.sh $i; done
 
 # Check if the ABCD_FOLDER variable is set in the environment, otherwise set it here
 if [[ -z "${ABCD_FOLDER}" ]]; then
@@ -17,6 +25,29 @@ fi
 
 CURRENT_FOLDER="$PWD"
 
+# Has to be the same as PORT_STRIDE in run_optimizer_PSD_p1.py
+PORT_STRIDE=100
+
+INSTANCE="$1"
+
+if [[ -n "${INSTANCE}" ]]; then
+    SESSION="ABCD_OPT_${INSTANCE}"
+    PORT_OFFSET=$((INSTANCE * PORT_STRIDE))
+else
+    SESSION="ABCD"
+    PORT_OFFSET=0
+fi
+
+# Replayed data goes to WaAn, that sends the analyzed data to spec
+ADDRESS_REPLAY_DATA="tcp://127.0.0.1:$((16207 + PORT_OFFSET))"
+ADDRESS_WAAN_STATUS="tcp://*:$((16206 + PORT_OFFSET))"
+ADDRESS_WAAN_DATA="tcp://*:$((16181 + PORT_OFFSET))"
+ADDRESS_WAAN_COMMANDS="tcp://*:$((16208 + PORT_OFFSET))"
+ADDRESS_SPEC_INPUT="tcp://127.0.0.1:$((16181 + PORT_OFFSET))"
+ADDRESS_SPEC_STATUS="tcp://*:$((16187 + PORT_OFFSET))"
+ADDRESS_SPEC_DATA="tcp://*:$((16188 + PORT_OFFSET))"
+ADDRESS_SPEC_COMMANDS="tcp://*:$((16189 + PORT_OFFSET))"
+
 TODAY="`date "+%Y%m%d"`"
 echo 'Today is '"$TODAY"
 
@@ -35,14 +66,28 @@ else
 
     echo "Replaying data file: ${FILE_NAME}"
 
-    # Checking if another ABCD session is running
-    if [ "`tmux ls 2> /dev/null | grep ABCD | wc -l`" -gt 0 ]
+    # Checking if another session with this name is running
+    if [ "`tmux ls 2> /dev/null | grep "^${SESSION}:" | wc -l`" -gt 0 ]
     then
-        echo "Kiling previous ABCD sessions"
-        tmux kill-session -t ABCD
+        echo "Kiling previous ${SESSION} session"
+        tmux kill-session -t "${SESSION}"
         sleep 2
     fi
 
+    if [[ -n "${INSTANCE}" ]]; then
+        echo "Starting optimization instance ${INSTANCE}, ports moved by ${PORT_OFFSET}"
+        tmux new-session -d -s "${SESSION}"
+
+        echo "Creating WaAn window"
+        tmux new-window -d -c "${ABCD_FOLDER}/waan/" -P -t "${SESSION}" -n waan "./waan -v -T 100 -A ${ADDRESS_REPLAY_DATA} -S ${ADDRESS_WAAN_STATUS} -D ${ADDRESS_WAAN_DATA} -C ${ADDRESS_WAAN_COMMANDS} -f ./configs/config_example_data.json"
+
+        echo "Creating spec windows"
+        tmux new-window -d -c "${ABCD_FOLDER}" -P -t "${SESSION}" -n spec "./spec/spec -A ${ADDRESS_SPEC_INPUT} -S ${ADDRESS_SPEC_STATUS} -D ${ADDRESS_SPEC_DATA} -C ${ADDRESS_SPEC_COMMANDS} -f ${CURRENT_FOLDER}/spec_Elias.json"
+
+        echo "Instance ${INSTANCE} started!"
+        exit 0
+    fi
+
     echo "Starting a new ABCD session"
     tmux new-session -d -s ABCD
 
@@ -61,7 +106,7 @@ else
     sleep 2
 
     echo "Creating WaAn window"
-    tmux new-window -d -c "${ABCD_FOLDER}/waan/" -P -t ABCD -n waan './waan -v -T 100 -A tcp://127.0.0.1:16207 -D tcp://*:16181 -f ./configs/config_example_data.json'
+    tmux new-window -d -c "${ABCD_FOLDER}/waan/" -P -t ABCD -n waan "./waan -v -T 100 -A ${ADDRESS_REPLAY_DATA} -D ${ADDRESS_WAAN_DATA} -f ./configs/config_example_data.json"
 
     echo "Creating DaSa window, folder: ${DATA_FOLDER}"
     tmux new-window -d -c "${DATA_FOLDER}" -P -t ABCD -n dasa "${ABCD_FOLDER}/dasa/dasa -v"
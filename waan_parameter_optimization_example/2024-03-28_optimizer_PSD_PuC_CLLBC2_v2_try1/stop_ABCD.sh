@@ -3,5 +3,17 @@
 # Unsetting $TMUX in order to be able to launch new sessions from tmux
 unset TMUX
 
-echo "Killing ABCD"
-tmux kill-session -t ABCD
+# With an instance number, only that optimization instance is stopped
+# With "all", every optimization instance is stopped
+if [[ "$1" == "all" ]]; then
+    for SESSION in `tmux ls -F '#{session_name}' 2> /dev/null | grep '^ABCD_OPT_'`; do
+        echo "Killing ${SESSION}"
+        tmux kill-session -t "${SESSION}"
+    done
+elif [[ -n "$1" ]]; then
+    echo "Killing ABCD_OPT_$1"
+    tmux kill-session -t "ABCD_OPT_$1"
+else
+    echo "Killing ABCD"
+    tmux kill-session -t ABCD
+fi